@@ -82,15 +82,14 @@ class Drone:
         print(f"Drone {self.drone_id} is performing an emergency landing.")
 
     async def subscribe_to_commands(self):
-        # Subscribe to incoming commands and process them
-        while True:
-            try:
-                command = await self.node.get(f"command-{self.drone_id}", ttl=60, tpf=10, ttp=5)
-                if command:
+        # Subscribe to incoming commands and process them, keeping any that
+        # arrive while an earlier command is still being processed
+        async with self.node.subscribe(f"command-{self.drone_id}", ttl=60, tpf=10, ttp=5, keep_all=True) as commands:
+            async for command in commands:
+                try:
                     await self.process_command(command)
-            except Exception as e:
-                logging.error(f"Error receiving command: {e}")
-                await asyncio.sleep(1)
+                except Exception as e:
+                    logging.error(f"Error processing command: {e}")
 
     async def run(self):
         # Start the node on a specific port and run the main functionalities of the drone
@@ -14,9 +14,9 @@ class DroneClient:
 
     async def listen_to_drone_data(self, drone_id):
         # Listen to data published by a specific drone
-        while True:
-            data = await self.node.get(f"{drone_id}-data", ttl=60, tpf=10, ttp=5)
-            print(f"Received data from drone {drone_id}: {data}")
+        async with self.node.subscribe(f"{drone_id}-data", ttl=60, tpf=10, ttp=5) as values:
+            async for data in values:
+                print(f"Received data from drone {drone_id}: {data}")
 
     async def start(self):
         # Start the client node
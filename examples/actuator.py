@@ -22,6 +22,7 @@ async def main():
     get_ttl = float(os.getenv("TCDICN_GET_TTL") or 90)  # Forget my interest
     get_tpf = int(os.getenv("TCDICN_GET_TPF") or 2)  # Remind about my interest
     get_ttp = float(os.getenv("TCDICN_GET_TTP") or 0.5)  # Deadline to respond
+    trace = os.getenv("TCDICN_TRACE") or None  # Trace 1 in this many items
     verb = os.getenv("TCDICN_VERBOSITY") or "info"  # Logging verbosity
     if name is None:
         sys.exit("Please give your sensor a unique ID by setting TCDICN_ID")
@@ -47,7 +48,8 @@ async def main():
             client["key"] = f.read()
 
     # Start ICN node as a client
-    node = tcdicn.Node()
+    trace = None if trace is None else int(trace)
+    node = tcdicn.Node(trace_every=trace)
     node_task = asyncio.create_task(node.start(port, dport, ttl, tpf, client))
 
     # Join every trusted client in a group
@@ -68,25 +70,15 @@ async def main():
 
     # Subscribe to random subset of data
     async def run_actuator():
-        tasks = set()
 
-        def subscribe(label):
+        async def subscribe(label):
             logging.info("Subscribing to %s...", label)
-            getter = node.get(label, get_ttl, get_tpf, get_ttp, group)
-            task = asyncio.create_task(getter, name=label)
-            tasks.add(task)
+            async with node.subscribe(
+                    label, get_ttl, get_tpf, get_ttp, group) as values:
+                async for value in values:
+                    logging.info("Received %s=%s", label, value)
 
-        for label in labels:
-            subscribe(label)
-
-        while True:
-            done, tasks = await asyncio.wait(
-                tasks, return_when=asyncio.FIRST_COMPLETED)
-            for task in done:
-                label = task.get_name()
-                value = task.result()
-                logging.info("Received %s=%s", label, value)
-                subscribe(label)
+        await asyncio.gather(*(subscribe(label) for label in labels))
     actuator_task = asyncio.create_task(run_actuator())
 
     # Serve debug information if requested
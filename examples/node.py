@@ -12,6 +12,17 @@ async def main():
     wport = os.getenv("TCDICN_WPORT") or None  # Debug web server port
     ttl = int(os.getenv("TCDICN_TTL") or 30)  # Forget me after 30s
     tpf = int(os.getenv("TCDICN_TPF") or 3)  # Remind peers every 30/3s
+    store = os.getenv("TCDICN_STORE") or None  # Content store directory
+    items = os.getenv("TCDICN_STORE_ITEMS") or None  # Max labels in memory
+    size = os.getenv("TCDICN_STORE_BYTES") or None  # Max bytes in memory
+    age = os.getenv("TCDICN_STORE_AGE") or None  # Forget data after seconds
+    cooldown = float(os.getenv("TCDICN_COOLDOWN") or 0)  # Re-advertise gap
+    race = os.getenv("TCDICN_RACE") or None  # Backup route stagger seconds
+    disc = os.getenv("TCDICN_DISCOVERY") or "broadcast"  # Or multicast/both
+    group = os.getenv("TCDICN_MCAST_GROUP") or tcdicn.MULTICAST_GROUP
+    hops = int(os.getenv("TCDICN_MCAST_TTL") or tcdicn.MULTICAST_TTL)
+    ifaces = os.getenv("TCDICN_MCAST_IFACES") or None  # eg "eth0,wlan0"
+    stall = float(os.getenv("TCDICN_STALL") or tcdicn.STALL_THRESHOLD)
     verb = os.getenv("TCDICN_VERBOSITY") or "info"  # Logging verbosity
 
     # Logging verbosity
@@ -20,17 +31,35 @@ async def main():
         format="%(asctime)s.%(msecs)03d [%(levelname)s] %(message)s",
         level=verbs[verb], datefmt="%H:%M:%S")
 
+    # Bound cached content and persist it to disk if requested
+    items = None if items is None else int(items)
+    size = None if size is None else int(size)
+    age = None if age is None else float(age)
+    race = None if race is None else float(race)
+    if store is None:
+        content_store = tcdicn.ContentStore(items, size, age)
+    else:
+        content_store = tcdicn.DiskContentStore(store, items or 256, size, age)
+
     # Start ICN node as a client
-    node = tcdicn.Node()
-    node_task = asyncio.create_task(node.start(port, dport, ttl, tpf))
+    node = tcdicn.Node(content_store, cooldown, race)
+    ifaces = None if ifaces is None else ifaces.split(",")
+    node_task = asyncio.create_task(node.start(
+        port, dport, ttl, tpf, None, disc, group, hops, ifaces))
+
+    # Report anything blocking the node for longer than stall seconds
+    watch_task = None
+    if stall > 0:
+        watch_task = asyncio.create_task(node.watch_loop(stall))
 
     # Serve debug information if requested
+    debug_task = None
     if wport is not None:
         debug_task = asyncio.create_task(node.serve_debug(int(wport)))
 
     # Run the ICN node until shutdown
     logging.info("Starting node...")
-    await tcdicn.Node().start(port, dport, ttl, tpf)
+    await node_task
     logging.info("Done.")
 
     # Stop everything
@@ -38,6 +67,8 @@ async def main():
         node_task.cancel()
     if debug_task is not None:
         debug_task.cancel()
+    if watch_task is not None:
+        watch_task.cancel()
 
 
 if __name__ == "__main__":
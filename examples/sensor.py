@@ -19,6 +19,7 @@ async def main():
     keyfile = os.getenv("TCDICN_KEYFILE") or None  # Private keyfile path
     trusteds = os.getenv("TCDICN_TRUSTEDS") or None  # Trusted client paths
     group = os.getenv("TCDICN_GROUP") or None  # Which group to make/join
+    trace = os.getenv("TCDICN_TRACE") or None  # Trace 1 in this many items
     verb = os.getenv("TCDICN_VERBOSITY") or "info"  # Logging verbosity
     if name is None:
         sys.exit("Please give your sensor a unique ID by setting TCDICN_ID")
@@ -44,7 +45,8 @@ async def main():
             client["key"] = f.read()
 
     # Start ICN node as a client
-    node = tcdicn.Node()
+    trace = None if trace is None else int(trace)
+    node = tcdicn.Node(trace_every=trace)
     node_task = asyncio.create_task(node.start(port, dport, ttl, tpf, client))
 
     # Join every trusted client in a group
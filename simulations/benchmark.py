@@ -0,0 +1,164 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sim
+import time
+from typing import Dict, List, Optional
+
+# Benchmarks the example sensor/actuator pattern over several topologies
+# Each topology is simulated for the same virtual duration under a few seeds,
+# and the pooled results are saved as JSON so runs can be compared over time
+# Usage: PYTHONPATH=. python3 simulations/benchmark.py --output before.json
+#        PYTHONPATH=. python3 simulations/benchmark.py --compare before.json
+
+# Topologies benchmarked by default
+TOPOLOGIES: List[str] = ["line", "ring", "mesh", "paths"]
+
+# Metrics shown when comparing results, with lower always being better
+COMPARED: List[str] = [
+    "latency_p50", "latency_p95", "latency_p99",
+    "datagrams_per_value", "connections_per_value", "bytes_per_value",
+    "cpu_per_node"]
+
+
+# Nearest rank percentile of some sorted values
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if len(values) == 0:
+        return None
+    rank = max(0, min(len(values) - 1, round(p / 100 * len(values)) - 1))
+    return values[rank]
+
+
+def per(total: float, count: int) -> Optional[float]:
+    return total / count if count != 0 else None
+
+
+# Simulate one topology under every seed and pool the results
+def benchmark(path: str, duration: float, seeds: List[str]) -> dict:
+    latencies = []
+    published = delivered = 0
+    datagrams = connections = wire = 0
+    cpu: Dict[str, float] = {}
+    start = time.perf_counter()
+    for seed in seeds:
+        network, results = sim.run(sim.simulate(path, duration, seed))
+        latencies += results.latencies
+        published += len(results.published)
+        delivered += len(results.latencies)
+        datagrams += network.datagrams
+        connections += network.connections
+        wire += network.datagram_bytes + network.stream_bytes
+        for host, seconds in results.cpu.items():
+            cpu[host] = cpu.get(host, 0) + seconds / len(seeds)
+    latencies.sort()
+    return {
+        "topology": os.path.splitext(os.path.basename(path))[0],
+        "published": published,
+        "delivered": delivered,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "latency_max": percentile(latencies, 100),
+        "datagrams": datagrams,
+        "connections": connections,
+        "bytes": wire,
+        "datagrams_per_value": per(datagrams, delivered),
+        "connections_per_value": per(connections, delivered),
+        "bytes_per_value": per(wire, delivered),
+        "cpu_per_node": per(sum(cpu.values()), len(cpu)),
+        "cpu": cpu,
+        "wall_seconds": time.perf_counter() - start,
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def show(value) -> str:
+    return "-" if value is None else f"{value:.4g}"
+
+
+def print_table(runs: List[dict]):
+    print(
+        f"{'topology':<10}{'values':>8}{'p50':>9}{'p95':>9}{'p99':>9}"
+        f"{'dgrams/v':>10}{'conns/v':>9}{'bytes/v':>10}{'cpu/node':>10}")
+    for run in runs:
+        print(
+            f"{run['topology']:<10}{run['delivered']:>8}"
+            f"{show(run['latency_p50']):>9}{show(run['latency_p95']):>9}"
+            f"{show(run['latency_p99']):>9}"
+            f"{show(run['datagrams_per_value']):>10}"
+            f"{show(run['connections_per_value']):>9}"
+            f"{show(run['bytes_per_value']):>10}"
+            f"{show(run['cpu_per_node']):>10}")
+
+
+# Print the relative change of each metric against a previous result file
+def print_comparison(before: dict, after: dict):
+    print(f"Compared to {before.get('commit')}:")
+    previous = {run["topology"]: run for run in before["runs"]}
+    for run in after["runs"]:
+        old = previous.get(run["topology"])
+        if old is None:
+            continue
+        changes = []
+        for metric in COMPARED:
+            if old.get(metric) and run.get(metric) is not None:
+                change = (run[metric] - old[metric]) / old[metric] * 100
+                changes.append(f"{metric}={change:+.1f}%")
+        print(f"- {run['topology']}: {', '.join(changes)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark tcdicn over the simulated topologies")
+    parser.add_argument(
+        "topologies", nargs="*", default=TOPOLOGIES,
+        help=f"topologies in simulations/ (default {' '.join(TOPOLOGIES)})")
+    parser.add_argument(
+        "--duration", type=float, default=3600,
+        help="seconds of virtual time per run (default 3600)")
+    parser.add_argument(
+        "--seeds", type=int, default=3, help="runs per topology (default 3)")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--compare", help="JSON results to compare against")
+    args = parser.parse_args()
+    sim.ensure_hash_seed()
+    logging.basicConfig(level=logging.ERROR)
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    seeds = [str(seed) for seed in range(args.seeds)]
+    runs = []
+    for topology in args.topologies:
+        path = os.path.join(here, topology + ".yml")
+        runs.append(benchmark(path, args.duration, seeds))
+    print_table(runs)
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "duration": args.duration,
+        "seeds": seeds,
+        "env": {k: v for k, v in os.environ.items() if k.startswith("TCDICN")},
+        "runs": runs,
+    }
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved results to {args.output}")
+    if args.compare is not None:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
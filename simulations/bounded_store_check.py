@@ -0,0 +1,84 @@
+import argparse
+import asyncio
+import logging
+import sys
+import tcdicn
+
+# Checks that get() never returns the same value twice, even when the content
+# store is too small to keep every label it has returned values of
+# Starts a sensor publishing a numbered value to labels "a" and "b" every
+# second, and an actuator with room for one label alternately getting them
+# Usage: PYTHONPATH=. python3 simulations/bounded_store_check.py
+
+
+async def check(port: int, rounds: int, timeout: float) -> bool:
+    sensor = tcdicn.Node()
+    actuator = tcdicn.Node(content_store=tcdicn.ContentStore(max_items=1))
+    tasks = [
+        asyncio.create_task(sensor.start(
+            port, port, 6, 3,
+            {"name": "sensor", "labels": ["a", "b"], "ttp": 0.2})),
+        asyncio.create_task(actuator.start(
+            port + 1, port, 6, 3,
+            {"name": "actuator", "labels": [], "ttp": 0.2}))]
+
+    async def publish():
+        i = 0
+        while True:
+            await sensor.set_many({"a": f"a{i}", "b": f"b{i}"})
+            await asyncio.sleep(1)
+            i += 1
+    publisher = asyncio.create_task(publish())
+
+    # Each label's values must only ever get newer
+    got = {"a": [], "b": []}
+    try:
+        for i in range(rounds):
+            for label in got:
+                value = await asyncio.wait_for(
+                    actuator.get(label, 6, 3, 0.2), timeout)
+                got[label].append(int(value[1:]))
+            values = await asyncio.wait_for(
+                actuator.get_many(list(got), 6, 3, 0.2), timeout)
+            for label, value in values.items():
+                got[label].append(int(value[1:]))
+        timed_out = False
+    except asyncio.TimeoutError:
+        timed_out = True
+
+    publisher.cancel()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(publisher, *tasks, return_exceptions=True)
+
+    ok = not timed_out
+    for label, values in got.items():
+        newer = all(x < y for x, y in zip(values, values[1:]))
+        print(f"{label}: {values}{'' if newer else ' (repeated)'}")
+        ok = ok and newer
+    if timed_out:
+        print("Timed out waiting for a new value")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check that get() on a bounded store never repeats")
+    parser.add_argument(
+        "--port", type=int, default=33360,
+        help="discovery port, with the second node on the next one")
+    parser.add_argument(
+        "--rounds", type=int, default=3, help="rounds of gets of each label")
+    parser.add_argument(
+        "--timeout", type=float, default=10,
+        help="seconds to wait for each new value")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    ok = asyncio.run(check(args.port, args.rounds, args.timeout))
+    print("PASS" if ok else "FAIL")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import argparse
+import asyncio
+import logging
+import sys
+import tcdicn
+
+# Checks that multicast discovery works over the loopback interface
+# Starts two client nodes announcing only to the multicast group on one
+# interface: "a" as the main node on the discovery port, and "b" beside it
+# On one host, b reaches a as its main node on the discovery port, so this
+# confirms that a discovers b through the group and that each then receives
+# the values the other publishes
+# Usage: PYTHONPATH=. python3 simulations/multicast_check.py
+
+
+async def check(port: int, interface: str, timeout: float) -> bool:
+    options = {"discovery": "multicast", "multicast_interfaces": [interface]}
+    a = tcdicn.Node()
+    b = tcdicn.Node()
+    tasks = [
+        asyncio.create_task(a.start(
+            port, port, 6, 3, {"name": "a", "labels": ["a"], "ttp": 0.2},
+            **options)),
+        asyncio.create_task(b.start(
+            port + 1, port, 6, 3, {"name": "b", "labels": ["b"], "ttp": 0.2},
+            **options))]
+
+    # Keep publishing until each node has heard from the other
+    async def publish():
+        i = 0
+        while True:
+            await asyncio.gather(a.set("a", str(i)), b.set("b", str(i)))
+            await asyncio.sleep(0.5)
+            i += 1
+    publisher = asyncio.create_task(publish())
+
+    try:
+        a_got, b_got = await asyncio.wait_for(asyncio.gather(
+            a.get("b", 6, 3, 0.2), b.get("a", 6, 3, 0.2)), timeout)
+    except asyncio.TimeoutError:
+        a_got, b_got = None, None
+    found = ("127.0.0.1", port + 1) in a.peers
+    joined = [a.multicast_joined, b.multicast_joined]
+
+    publisher.cancel()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(publisher, *tasks, return_exceptions=True)
+
+    print(f"Joined the group on: a={sorted(joined[0])} b={sorted(joined[1])}")
+    print(f"a discovered b: {found}")
+    print(f"a received from b: {a_got}")
+    print(f"b received from a: {b_got}")
+    return all(joined) and found and a_got is not None and b_got is not None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check multicast discovery between two local nodes")
+    parser.add_argument(
+        "--port", type=int, default=33350,
+        help="discovery port, with the second node on the next one")
+    parser.add_argument(
+        "--interface", default="lo", help="interface to multicast on")
+    parser.add_argument(
+        "--timeout", type=float, default=15,
+        help="seconds to wait for the nodes to hear from each other")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    ok = asyncio.run(check(args.port, args.interface, args.timeout))
+    print("PASS" if ok else "FAIL")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,560 @@
+import argparse
+import asyncio
+import contextvars
+import ipaddress
+import logging
+import os
+import random
+import re
+import selectors
+import sys
+import tcdicn
+import time
+import yaml
+from typing import Dict, List, Optional, Tuple
+
+Addr = Tuple[str, int]
+
+# Runs the Docker Compose topologies in this directory inside one process
+# Each compose network becomes a simulated broadcast domain and each service
+# a tcdicn.Node behaving like the example it extends, all sharing a virtual
+# clock so that hours of protocol time pass in seconds, identically every run
+# Usage: PYTHONPATH=. python3 simulations/sim.py simulations/ring.yml 3600
+
+# UNIX timestamp that virtual time starts counting from
+EPOCH: float = 1700000000
+
+# Default one way delay of every link in seconds
+LATENCY: float = 0.001
+
+# Subnet given to services which do not list any networks
+DEFAULT_SUBNET: str = "10.0.0.0/24"
+
+# Labels that the example sensors and actuators choose from
+LABELS: List[str] = ["foo", "bar", "baz", "qux", "quux"]
+
+# Name of the host whose work is currently running, for CPU accounting
+HOST = contextvars.ContextVar("host", default=None)
+
+
+# Event loop on virtual time: whenever nothing is ready to run, the clock
+# jumps straight to the next scheduled callback instead of sleeping
+# Also counts the real CPU time spent running callbacks on behalf of each host
+class VirtualEventLoop(asyncio.SelectorEventLoop):
+    def __init__(self, epoch: float = EPOCH):
+        self.virtual = 0.0
+        self.epoch = epoch
+        self.cpu: Dict[Optional[str], float] = {}  # Host name>Seconds
+        super().__init__(VirtualSelector(self))
+
+    def time(self) -> float:
+        return self.virtual
+
+    def call_soon(self, callback, *args, context=None):
+        return super().call_soon(self.timed, callback, *args, context=context)
+
+    def call_at(self, when, callback, *args, context=None):
+        return super().call_at(
+            when, self.timed, callback, *args, context=context)
+
+    # Runs within the callback's context, so HOST tells us who to charge
+    def timed(self, callback, *args):
+        start = time.process_time()
+        try:
+            callback(*args)
+        finally:
+            host = HOST.get()
+            self.cpu[host] = self.cpu.get(host, 0) \
+                + time.process_time() - start
+
+    # Picked up by tcdicn.clock() for every node running on this loop
+    def wall_time(self) -> float:
+        return self.epoch + self.virtual
+
+
+class VirtualSelector(selectors.SelectSelector):
+    def __init__(self, loop: VirtualEventLoop):
+        super().__init__()
+        self.loop = loop
+
+    def select(self, timeout: Optional[float] = None):
+        events = super().select(0)  # Only the loop's own self-pipe
+        if len(events) != 0 or timeout == 0:
+            return events
+        if timeout is None:
+            raise RuntimeError("Simulation has nothing left to do")
+        self.loop.virtual += timeout
+        return []
+
+
+# A broadcast domain, such as one compose network
+class Link:
+    def __init__(
+            self, name: str, network: ipaddress.IPv4Network,
+            latency: float, loss: float):
+        self.name = name
+        self.network = network
+        self.latency = latency
+        self.loss = loss  # Probability of dropping each datagram
+        self.hosts: Dict[str, Host] = {}  # IP>Host
+        self.addrs = network.hosts()
+        next(self.addrs)  # Leave .1 for the gateway, like Docker
+
+
+# A simulated device with an address on each of its links
+class Host:
+    def __init__(self, name: str):
+        self.name = name
+        self.interfaces: List[tcdicn.Interface] = []
+        self.udp: Dict[int, SimDatagramTransport] = {}  # Port>Transport
+        self.tcp: Dict[int, object] = {}  # Port>Connection callback
+        self.up = True
+        self.context = contextvars.copy_context()  # Runs all work for host
+        self.context.run(HOST.set, name)
+
+
+class Simulation:
+    def __init__(self, seed: str = "0", latency: float = LATENCY):
+        self.random = random.Random(f"{seed}/network")
+        self.seed = seed
+        self.latency = latency
+        self.links: Dict[str, Link] = {}
+        self.hosts: Dict[str, Host] = {}
+        self.ports = iter(range(40000, 2**31))  # Ephemeral ports
+        self.datagrams = 0  # Datagrams delivered to a listening node
+        self.datagram_bytes = 0
+        self.connections = 0  # TCP connections established
+        self.stream_bytes = 0
+
+    def add_link(self, name: str, subnet: str, loss: float = 0) -> Link:
+        network = ipaddress.IPv4Network(subnet)
+        self.links[name] = Link(name, network, self.latency, loss)
+        return self.links[name]
+
+    def add_host(self, name: str, links: List[str]) -> Host:
+        host = Host(name)
+        for name in links:
+            link = self.links[name]
+            addr = str(next(link.addrs))
+            link.hosts[addr] = host
+            host.interfaces.append(tcdicn.Interface(name, addr, link.network))
+        self.hosts[host.name] = host
+        return host
+
+    # Deliver to every host on a link for broadcasts, or to one for unicast
+    def sendto(self, host: Host, port: int, data: bytes, dst: Addr):
+        loop = asyncio.get_running_loop()
+        ip, dport = dst
+        for interface in host.interfaces:
+            link = self.links[interface.name]
+            if ip == interface.broadcast:
+                targets = list(link.hosts.values())
+            elif ip in link.hosts:
+                targets = [link.hosts[ip]]
+            else:
+                continue
+            for target in targets:
+                if target is host or not target.up:
+                    continue
+                if link.loss > 0 and self.random.random() < link.loss:
+                    continue
+                transport = target.udp.get(dport)
+                if transport is not None:
+                    self.datagrams += 1
+                    self.datagram_bytes += len(data)
+                    loop.call_later(
+                        link.latency, transport.deliver,
+                        data, (interface.addr, port), context=target.context)
+
+    # Connect to a listening host sharing a link with us (or ourselves)
+    async def connect(self, host: Host, addr: Addr, timeout: float):
+        ip, port = addr
+        target, src, latency = None, "127.0.0.1", 0
+        if ip == "127.0.0.1":
+            target = host
+        for interface in host.interfaces:
+            link = self.links[interface.name]
+            if ip in link.hosts:
+                target, src, latency = link.hosts[ip], interface.addr, \
+                    link.latency
+                break
+        if target is None or not target.up or not host.up:
+            await asyncio.sleep(timeout)
+            raise asyncio.TimeoutError()
+        await asyncio.sleep(2 * latency)
+        callback = target.tcp.get(port)
+        if callback is None:
+            raise ConnectionRefusedError(f"Nothing listening on {addr}")
+        self.connections += 1
+
+        # Pair up a stream in each direction
+        local = (src, next(self.ports))
+        client_reader = asyncio.StreamReader()
+        server_reader = asyncio.StreamReader()
+        client_writer = SimStreamWriter(
+            self, server_reader, latency, addr, local)
+        server_writer = SimStreamWriter(
+            self, client_reader, latency, local, addr)
+        asyncio.create_task(
+            callback(server_reader, server_writer), context=target.context)
+        return client_reader, client_writer
+
+
+# Datagram endpoint of a node, in place of asyncio's DatagramTransport
+class SimDatagramTransport:
+    def __init__(self, sim: Simulation, host: Host, port: int, protocol):
+        self.sim = sim
+        self.host = host
+        self.port = port
+        self.protocol = protocol
+        self.closing = False
+
+    def sendto(self, data: bytes, addr: Addr):
+        self.sim.sendto(self.host, self.port, data, addr)
+
+    def deliver(self, data: bytes, addr: Addr):
+        if not self.closing and self.host.up:
+            self.protocol.datagram_received(data, addr)
+
+    def get_extra_info(self, name: str, default=None):
+        return default
+
+    def is_closing(self) -> bool:
+        return self.closing
+
+    def close(self):
+        if not self.closing:
+            self.closing = True
+            self.host.udp.pop(self.port, None)
+            self.protocol.connection_lost(None)
+
+
+# Writes into the other end's StreamReader after the link latency
+# Everything written before a delivery is delivered with it, keeping order
+class SimStreamWriter:
+    def __init__(
+            self, sim: Simulation, reader: asyncio.StreamReader,
+            latency: float, peername: Addr, sockname: Addr):
+        self.sim = sim
+        self.reader = reader
+        self.latency = latency
+        self.info = {"peername": peername, "sockname": sockname}
+        self.pending: List[bytes] = []
+        self.is_scheduled = False
+        self.closing = False
+        self.closed = False
+
+    def write(self, data: bytes):
+        if self.closing:
+            return
+        self.pending.append(bytes(data))
+        self.sim.stream_bytes += len(data)
+        self.schedule()
+
+    def schedule(self):
+        if not self.is_scheduled:
+            self.is_scheduled = True
+            asyncio.get_running_loop().call_later(self.latency, self.flush)
+
+    def flush(self):
+        self.is_scheduled = False
+        for data in self.pending:
+            self.reader.feed_data(data)
+        self.pending = []
+        if self.closing and not self.closed:
+            self.closed = True
+            self.reader.feed_eof()
+
+    async def drain(self):
+        await asyncio.sleep(0)
+
+    def close(self):
+        self.closing = True
+        self.schedule()
+
+    def is_closing(self) -> bool:
+        return self.closing
+
+    async def wait_closed(self):
+        pass
+
+    def get_extra_info(self, name: str, default=None):
+        return self.info.get(name, default)
+
+
+# Stands in for the asyncio Server returned by asyncio.start_server
+class SimServer:
+    def __init__(self, host: Host, port: int):
+        self.host = host
+        self.port = port
+        self.closed = asyncio.get_running_loop().create_future()
+
+    async def serve_forever(self):
+        await self.closed
+
+    def close(self):
+        if self.host.tcp.get(self.port) is not None:
+            del self.host.tcp[self.port]
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+    async def wait_closed(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+
+# The view of the simulated network from one host
+class SimNetwork(tcdicn.Network):
+    def __init__(self, sim: Simulation, host: Host):
+        self.sim = sim
+        self.host = host
+
+    async def listen_udp(self, protocol_factory, port: int):
+        protocol = protocol_factory()
+        transport = SimDatagramTransport(self.sim, self.host, port, protocol)
+        self.host.udp[port] = transport
+        protocol.connection_made(transport)
+        return transport
+
+    async def listen_tcp(self, callback, port: int):
+        self.host.tcp[port] = callback
+        return SimServer(self.host, port)
+
+    async def connect(self, addr: Addr, timeout: float):
+        return await self.sim.connect(self.host, addr, timeout)
+
+    async def interfaces(self) -> List[tcdicn.Interface]:
+        return list(self.host.interfaces)
+
+
+# A compose service resolved through its extends chain
+class Service:
+    def __init__(self, name: str, role: str, env: dict, networks: List[str]):
+        self.name = name
+        self.role = role  # node, sensor or actuator (see examples/)
+        self.env = env
+        self.networks = networks
+
+
+def load_services(path: str) -> Tuple[Dict[str, Service], Dict[str, str]]:
+    with open(path) as f:
+        compose = yaml.safe_load(f)
+
+    def environment(service: dict) -> dict:
+        env = service.get("environment") or {}
+        if isinstance(env, list):
+            env = dict(e.split("=", 1) for e in env)
+        # Substitute variables like compose does, unset ones being empty
+        return {
+            key: re.sub(
+                r"\$\{?(\w+)\}?", lambda m: os.getenv(m[1], ""),
+                "" if value is None else str(value))
+            for key, value in env.items()}
+
+    def resolve(path: str, name: str) -> Tuple[str, dict, list]:
+        with open(path) as f:
+            service = yaml.safe_load(f)["services"][name]
+        extends = service.get("extends")
+        if extends is None:
+            role, env, networks = name, {}, None
+        else:
+            base = os.path.join(os.path.dirname(path), extends["file"])
+            role, env, networks = resolve(base, extends["service"])
+        env = {**env, **environment(service)}
+        return role, env, service.get("networks", networks)
+
+    services = {}
+    for name in compose["services"]:
+        role, env, networks = resolve(path, name)
+        services[name] = Service(name, role, env, networks or ["default"])
+
+    subnets = {"default": DEFAULT_SUBNET}
+    for name, network in (compose.get("networks") or {}).items():
+        subnets[name] = network["ipam"]["config"][0]["subnet"]
+    return services, subnets
+
+
+# Records when values are published and received, to measure latency
+class Results:
+    def __init__(self):
+        self.published: Dict[Tuple[str, str], float] = {}  # Label,value>At
+        self.latencies: List[float] = []
+        self.received = 0
+        self.unknown = 0  # Values received which were never published
+        self.cpu: Dict[str, float] = {}  # Host name>CPU seconds used
+
+    def publish(self, label: str, value: str):
+        self.published[(label, value)] = tcdicn.clock()
+
+    def receive(self, label: str, value: str):
+        self.received += 1
+        at = self.published.get((label, value))
+        if at is None:
+            self.unknown += 1
+        else:
+            self.latencies.append(tcdicn.clock() - at)
+
+
+# Run a service the same way as the example script it extends
+async def run_service(
+        sim: Simulation, service: Service, results: Results,
+        network: tcdicn.Network, rand: random.Random):
+    env = service.env
+    port = int(env.get("TCDICN_PORT") or 33333)
+    dport = int(env.get("TCDICN_DPORT") or port)
+    ttl = float(env.get("TCDICN_TTL") or 30)
+    tpf = int(env.get("TCDICN_TPF") or 3)
+    ttp = float(env.get("TCDICN_TTP") or 5)
+    get_ttl = float(env.get("TCDICN_GET_TTL") or 90)
+    get_tpf = int(env.get("TCDICN_GET_TPF") or 2)
+    get_ttp = float(env.get("TCDICN_GET_TTP") or 0.5)
+    name = env.get("TCDICN_ID") or service.name
+    if env.get("TCDICN_GROUP"):
+        logging.warning("%s: groups are not simulated, ignoring", name)
+
+    # Like the random start delay in basic.yml
+    await asyncio.sleep(rand.uniform(0, 5))
+
+    node = tcdicn.Node(network=network)
+    node.id = name
+    node.log = logging.getLogger(f"tcdicn.{service.name}")
+    node.timers.log = node.log
+    labels = rand.sample(LABELS, rand.randint(1, 3)) + ["always"]
+    client = None
+    if service.role == "sensor":
+        client = {"name": name, "ttp": ttp, "labels": labels}
+    elif service.role == "actuator":
+        client = {"name": name, "ttp": ttp, "labels": []}
+    tasks = [asyncio.create_task(node.start(port, dport, ttl, tpf, client))]
+
+    async def run_sensor():
+        count = 0
+        while True:
+            await asyncio.sleep(rand.uniform(10, 30))
+            label = rand.choice(labels)
+            count += 1
+            value = f"{name}#{count}"
+            results.publish(label, value)
+            await node.set(label, value)
+
+    async def run_actuator(label: str):
+        async with node.subscribe(
+                label, get_ttl, get_tpf, get_ttp) as values:
+            async for value in values:
+                results.receive(label, value)
+
+    if service.role == "sensor":
+        tasks.append(asyncio.create_task(run_sensor()))
+    elif service.role == "actuator":
+        for label in labels:
+            tasks.append(asyncio.create_task(run_actuator(label)))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def simulate(
+        path: str, duration: float, seed: str = "0",
+        latency: float = LATENCY, loss: float = 0) -> Tuple[Simulation, Results]:
+    sim = Simulation(seed, latency)
+    results = Results()
+    services, subnets = load_services(path)
+    for service in services.values():
+        for network in service.networks:
+            if network not in sim.links:
+                sim.add_link(network, subnets[network], loss)
+
+    tasks = []
+    for service in services.values():
+        host = sim.add_host(service.name, service.networks)
+        network = SimNetwork(sim, host)
+        rand = random.Random(f"{seed}/{service.name}")
+        tasks.append(asyncio.create_task(
+            run_service(sim, service, results, network, rand),
+            context=host.context))
+
+    await asyncio.sleep(duration)
+    for task in tasks:
+        if task.done():
+            task.result()  # Raise whatever stopped the service early
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    cpu = getattr(asyncio.get_running_loop(), "cpu", {})
+    results.cpu = {name: cpu.get(name, 0) for name in sim.hosts}
+    return sim, results
+
+
+# Runs coroutine to completion on virtual time
+def run(coroutine, epoch: float = EPOCH):
+    loop = VirtualEventLoop(epoch)
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(
+            asyncio.gather(*tasks, return_exceptions=True))
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+# Set iteration order depends on string hashing, so fix it for repeatability
+def ensure_hash_seed():
+    if os.getenv("PYTHONHASHSEED") is None:
+        os.environ["PYTHONHASHSEED"] = "0"
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Simulate a tcdicn topology on virtual time")
+    parser.add_argument("topology", help="compose file, eg simulations/ring.yml")
+    parser.add_argument(
+        "duration", type=float, nargs="?", default=3600,
+        help="seconds of virtual time to run for (default 3600)")
+    parser.add_argument("--seed", default="0")
+    parser.add_argument("--latency", type=float, default=LATENCY)
+    parser.add_argument("--loss", type=float, default=0)
+    parser.add_argument(
+        "--verbosity", default="warn", choices=["dbug", "info", "warn"])
+    args = parser.parse_args()
+    ensure_hash_seed()
+
+    # Log with virtual timestamps
+    verbs = {"dbug": logging.DEBUG, "info": logging.INFO, "warn": logging.WARN}
+    logging.basicConfig(
+        format="%(vtime)10.3f [%(levelname)s] %(name)s: %(message)s",
+        level=verbs[args.verbosity])
+
+    def add_vtime(record: logging.LogRecord) -> bool:
+        loop = asyncio._get_running_loop()
+        record.vtime = loop.time() if loop is not None else 0
+        return True
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(add_vtime)
+
+    sim, results = run(simulate(
+        args.topology, args.duration, args.seed, args.latency, args.loss))
+
+    latencies = sorted(results.latencies)
+    print(f"Simulated {args.duration}s of {args.topology}")
+    print(f"Published: {len(results.published)} values")
+    print(f"Received: {results.received} values")
+    if len(latencies) != 0:
+        mean = sum(latencies) / len(latencies)
+        print(f"Latency: mean={mean:.3f}s max={latencies[-1]:.3f}s")
+    print(f"Datagrams: {sim.datagrams} ({sim.datagram_bytes} bytes)")
+    print(f"TCP: {sim.connections} connections ({sim.stream_bytes} bytes)")
+
+
+if __name__ == "__main__":
+    main()
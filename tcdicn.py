@@ -1,22 +1,34 @@
 import asyncio
 import base64
+import bisect
+import copy
+import heapq
 import http
 import ipaddress
+import itertools
 import json
 import logging
-import queue
+import math
+import mmap
+import os
 import signal
 import socket
+import struct
+import sys
+import threading
 import time
+import traceback
+import urllib.parse
 from abc import ABC, abstractmethod
 from asyncio import Task, Future, DatagramTransport, StreamWriter, StreamReader
+from collections import OrderedDict, deque
 from cryptography.exceptions import InvalidSignature
 from cryptography.fernet import Fernet, InvalidToken
 from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from json import JSONDecodeError
 from logging import Logger, LoggerAdapter
-from typing import Dict, Tuple, List, Optional
+from typing import Dict, Tuple, List, Optional, Set
 
 # The version of this protocol implementation is included in all communications
 # This allows peers which implement one or more versions to react appropriately
@@ -40,6 +52,124 @@ DATA_TIMEOUT: float = 2
 # Seconds to wait before retrying after exhausting all known routes to client
 DEADLINE_EXT: float = 10
 
+# Default minimum seconds between re-broadcasts of the same client's advert
+# Adverts arriving sooner are held back (and coalesced) until it has passed
+ADVERT_COOLDOWN: float = 0
+
+# Route cost of forwarding through a peer, in the same units as scores
+# Each hop costs 1, plus penalties for the peer's smoothed send latency
+# (per second), failure rate (from 0 to 1) and queue depth (per queued item)
+# Latency and depth are only penalised above what a healthy LAN peer sees,
+# so that equally good routes are not flipped between by measurement noise
+ROUTE_COST_LATENCY: float = 10
+ROUTE_COST_FAILURE: float = 5
+ROUTE_COST_QUEUE: float = 0.1
+ROUTE_COST_MIN_LATENCY: float = 0.01
+ROUTE_COST_MIN_DEPTH: float = 1
+
+# Weight of each new sample in a peer's smoothed send statistics, and the
+# seconds after which penalties halve while nothing is sent to the peer
+ROUTE_COST_ALPHA: float = 0.2
+ROUTE_COST_HALF_LIFE: float = 60
+
+# Suggested seconds to wait for the best route to a client to connect before
+# also trying the next best one, for items that cannot afford a TCP_TIMEOUT
+RACE_STAGGER: float = 0.25
+
+# Consecutive failed sends after which a peer is skipped when routing, and
+# the seconds until it is first probed in the background, doubling after
+# each failed probe up to the maximum
+BREAKER_FAILURES: int = 3
+BREAKER_RESET: float = 5
+BREAKER_MAX_RESET: float = 60
+
+# Seconds to keep an unused persistent TCP connection to a peer open
+# Receivers wait twice as long so that senders are always first to close
+CONNECTION_IDLE: float = 30
+
+# Largest length prefixed message accepted over a persistent TCP connection
+# Keeping this under 16MiB means framed streams always start with a 0 byte,
+# which distinguishes them from connect-per-message JSON (starting with "{")
+MAX_FRAME: int = 2 ** 24 - 1
+
+# Byte a receiver answers each message over a persistent connection with
+# Writes to a peer which vanished without closing the connection still succeed,
+# so a message only counts as sent once it has been acknowledged
+STREAM_ACK: bytes = b"\x06"
+
+# Optional protocol features advertised in PeerItems as a bitmask
+# Peers only use a feature when sending to a peer which advertised it
+FEATURE_STREAM: int = 1  # Persistent length prefixed, acked connections
+FEATURE_BINARY: int = 2  # Compact binary message encoding
+FEATURES: int = FEATURE_STREAM | FEATURE_BINARY  # Features we support
+
+# First byte of binary encoded messages, identifying the binary codec version
+# Can never start a JSON encoded message, so both can be received anywhere
+BINARY_MAGIC: bytes = b"\xb1"
+
+# Default group and hop limit used by the multicast discovery mode
+# 239.255.0.0/16 is administratively scoped, so it stays within the site
+MULTICAST_GROUP: str = "239.255.33.33"
+MULTICAST_TTL: int = 1
+
+# Seconds between background refreshes of the local network interface table
+INTERFACE_REFRESH: float = 30
+
+# Bytes appended to a disk content store segment before starting a new one
+SEGMENT_SIZE: int = 4 * 2 ** 20
+
+# Seconds between checks of whether disk content store segments need compacting
+COMPACT_INTERVAL: float = 60
+
+# Seconds between background sweeps of content older than its max age
+STORE_SWEEP: float = 10
+
+# Granularity in seconds of the timer wheel used to expire node table entries
+# Entries expire at most this many seconds after their End Of Life (EOL)
+TIMER_RESOLUTION: float = 0.1
+
+# Number of slots in the timer wheel, so one turn covers SLOTS * RESOLUTION
+# seconds (longer timers just stay in their slot for more turns)
+TIMER_SLOTS: int = 1024
+
+# Upper bounds of the histogram buckets exported for batch sizes (in items)
+# and for the seconds left until an item's deadline when it is sent
+METRICS_BATCH_BUCKETS: Tuple[float, ...] = (1, 2, 4, 8, 16, 32, 64)
+METRICS_SLACK_BUCKETS: Tuple[float, ...] = (
+    -1, -0.1, 0, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Node methods which can be timed at runtime (see Node.set_handler_timing)
+# and the upper bounds of the buckets of seconds their calls are counted in
+# Coroutines are timed from start to finish, so include waiting on peers
+TIMED_HANDLERS: List[str] = [
+    "on_datagram", "on_message", "on_peer", "on_advert", "on_get", "on_set",
+    "batch_send", "batch_broadcast"]
+METRICS_HANDLER_BUCKETS: Tuple[float, ...] = (
+    1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 0.01, 0.05, 0.1, 0.5, 1)
+
+# Seconds between stack samples taken by the sampling profiler, and the
+# longest it can be asked to run for
+PROFILE_INTERVAL: float = 0.005
+PROFILE_MAX_SECONDS: float = 60
+
+# Default seconds the event loop can be kept from handling events before
+# the code keeping it busy is reported as having stalled it, and how many
+# times per threshold the loop lag is checked (see Node.watch_loop)
+# Also the upper bounds of the buckets of measured loop lag in seconds
+STALL_THRESHOLD: float = 0.1
+STALL_CHECKS: int = 4
+METRICS_LAG_BUCKETS: Tuple[float, ...] = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+
+# Most nodes a traced item records itself passing through, which bounds the
+# size of its trace, and how many delivered traces a node keeps for /traces
+TRACE_MAX_HOPS: int = 32
+TRACE_HISTORY: int = 100
+
+# Default number of values buffered per subscription keeping all of them,
+# beyond which the oldest unread values are dropped
+SUBSCRIBE_BUFFER: int = 64
+
 # Peers are identified solely by their host and port number
 Addr = Tuple[str, int]
 
@@ -50,21 +180,216 @@ class ContextLogger(LoggerAdapter):
         return f"{self.extra} | {msg}", kwargs
 
 
+# Current UNIX timestamp according to the running event loop
+# A loop may keep its own wall clock by providing a wall_time() method, which
+# is how simulations run many nodes on virtual time (see simulations/sim.py)
+def clock() -> float:
+    return getattr(asyncio._get_running_loop(), "wall_time", time.time)()
+
+
 # Convert a UNIX timestamp into a human readable seconds since string
 def to_human(timestamp: float) -> str:
-    secs = timestamp - time.time()
+    secs = timestamp - clock()
     return f"in {secs} seconds" if secs >= 0 else f"{-secs} seconds ago"
 
 
 # Execute callback after End Of Life timestamp - Useful for implementing caches
 def do_after(eol: float, callback) -> Task:
     async def on_timeout():
-        await asyncio.sleep(eol - time.time())
+        await asyncio.sleep(eol - clock())
         callback()
 
     return asyncio.create_task(on_timeout())
 
 
+# A callback registered with a TimerWheel to be executed after some EOL
+class Timer:
+    __slots__ = ("tick", "callback", "slot")
+
+    def __init__(self, callback):
+        self.tick: int = 0
+        self.callback = callback
+        self.slot: Optional[Dict["Timer", None]] = None  # None once inactive
+
+
+# Executes many callbacks after their EOLs from a single background task
+# Timers are hashed into slots by their EOL tick, making adding, refreshing
+# and cancelling O(1) while each tick only has to look at its own slot
+# Replaces one do_after() task per entry for the node tables
+class TimerWheel:
+    def __init__(
+            self, log: Logger,
+            resolution: float = TIMER_RESOLUTION, slots: int = TIMER_SLOTS):
+        self.log = log
+        self.resolution = resolution
+        self.wheel: List[Dict[Timer, None]] = [{} for _ in range(slots)]
+        self.tick = math.floor(clock() / resolution)  # Last processed
+        self.count = 0  # Number of active timers
+        self.next: Optional[int] = None  # Tick the wheel is sleeping until
+        self.task: Optional[Task] = None
+        self.wakeup: Optional[Future] = None
+
+    # Schedule a callback to run after EOL
+    # Passing the entry's previous timer refreshes it in place instead
+    def add(
+            self, eol: float, callback,
+            timer: Optional[Timer] = None) -> Timer:
+        if timer is None:
+            timer = Timer(callback)
+        elif timer.slot is not None:
+            del timer.slot[timer]
+            self.count -= 1
+        timer.callback = callback
+        if self.count == 0:
+            # Skip over any ticks we slept through while idle
+            self.tick = max(
+                self.tick, math.floor(clock() / self.resolution) - 1)
+        timer.tick = max(math.ceil(eol / self.resolution), self.tick + 1)
+        timer.slot = self.wheel[timer.tick % len(self.wheel)]
+        timer.slot[timer] = None
+        self.count += 1
+
+        # Make sure the wheel is turning in time for this timer
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        elif self.next is None or timer.tick < self.next:
+            self.wake()
+        return timer
+
+    def wake(self):
+        if self.wakeup is not None and not self.wakeup.done():
+            self.wakeup.set_result(None)
+
+    # Stop a timer from running its callback
+    def cancel(self, timer: Timer):
+        if timer.slot is not None:
+            del timer.slot[timer]
+            timer.slot = None
+            self.count -= 1
+
+    # First tick after now with a timer due, or a turn later if there are
+    # only timers due in later turns, or None if there are no timers at all
+    def next_tick(self, now: int) -> Optional[int]:
+        if self.count == 0:
+            return None
+        for tick in range(now + 1, now + len(self.wheel)):
+            if any(t.tick <= tick for t in self.wheel[tick % len(self.wheel)]):
+                return tick
+        return now + len(self.wheel)
+
+    # Turn the wheel, sleeping until the next tick with a timer due
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = math.floor(clock() / self.resolution)
+
+            # Visit each slot at most once, even if we fell behind a turn
+            start = max(self.tick + 1, now - len(self.wheel) + 1)
+            for tick in range(start, now + 1):
+                self.tick = tick  # So callbacks can only add to later ticks
+                slot = self.wheel[tick % len(self.wheel)]
+                expired = [timer for timer in slot if timer.tick <= now]
+                for timer in expired:
+                    del slot[timer]
+                    timer.slot = None
+                    self.count -= 1
+                    try:
+                        timer.callback()
+                    except Exception as exc:
+                        self.log.exception("Timer callback failed: %s", exc)
+
+            # Sleep until woken by a new earlier timer or the next one is due
+            self.next = self.next_tick(now)
+            self.wakeup = loop.create_future()
+            handle = None
+            if self.next is not None:
+                delay = self.next * self.resolution - clock()
+                handle = loop.call_later(max(0, delay), self.wake)
+            await self.wakeup
+            self.wakeup = None
+            if handle is not None:
+                handle.cancel()
+
+    # Stop turning the wheel, without running any remaining callbacks
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+# A local IPv4 network interface we can broadcast discovery messages on
+class Interface:
+    def __init__(self, name: str, addr: str, network: ipaddress.IPv4Network):
+        self.name = name
+        self.addr = addr
+        self.network = network
+        self.broadcast = str(network.broadcast_address)
+
+
+# List the IPv4 interfaces that are up along with their real netmasks
+# Uses Linux ioctls, falling back to resolving our hostname with a /24 subnet
+# Blocking, so run it in an executor rather than on the event loop
+def get_interfaces() -> List[Interface]:
+    try:
+        import fcntl
+        ifaces = []
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            for _, name in socket.if_nameindex():
+                req = struct.pack("256s", name.encode()[:15])
+                res = fcntl.ioctl(s.fileno(), 0x8913, req)  # SIOCGIFFLAGS
+                flags = struct.unpack("H", res[16:18])[0]
+                if not flags & 0x1:  # IFF_UP
+                    continue
+                if not flags & (0x2 | 0x8):  # IFF_BROADCAST | IFF_LOOPBACK
+                    continue
+                try:
+                    res = fcntl.ioctl(s.fileno(), 0x8915, req)  # SIOCGIFADDR
+                except OSError:
+                    continue  # No IPv4 address assigned
+                addr = socket.inet_ntoa(res[20:24])
+                res = fcntl.ioctl(s.fileno(), 0x891b, req)  # SIOCGIFNETMASK
+                mask = socket.inet_ntoa(res[20:24])
+                net = ipaddress.IPv4Network(f"{addr}/{mask}", False)
+                ifaces.append(Interface(name, addr, net))
+        return ifaces
+    except (ImportError, OSError):
+        host = socket.gethostname()
+        addrs = socket.getaddrinfo(
+            host, None, family=socket.AF_INET, proto=socket.IPPROTO_UDP)
+        return [
+            Interface(host, addr, ipaddress.IPv4Network(addr + "/24", False))
+            for (_, _, _, _, (addr, _)) in addrs]
+
+
+# How a node reaches the network: real UDP and TCP sockets on every interface
+# Simulations substitute their own to run many nodes inside one process
+class Network:
+
+    # Bind a broadcast capable UDP endpoint, returning its transport
+    async def listen_udp(self, protocol_factory, port: int):
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(
+            protocol_factory, local_addr=("0.0.0.0", port),
+            allow_broadcast=True)
+        return transport
+
+    # Accept TCP connections, returning an asyncio Server
+    async def listen_tcp(self, callback, port: int):
+        return await asyncio.start_server(callback, "0.0.0.0", port)
+
+    # Open a TCP connection, raising OSError or TimeoutError on failure
+    async def connect(
+            self, addr: Addr,
+            timeout: float) -> Tuple[StreamReader, StreamWriter]:
+        connection = asyncio.open_connection(addr[0], addr[1])
+        return await asyncio.wait_for(connection, timeout=timeout)
+
+    # List local interfaces without blocking the event loop
+    async def interfaces(self) -> List[Interface]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, get_interfaces)
+
+
 # Encode dict as bytes for transmission
 def encode(d: dict) -> bytes:
     return json.dumps(d, separators=(",", ":")).encode()
@@ -75,6 +400,64 @@ def decode(d: bytes) -> dict:
     return json.loads(d)
 
 
+# Binary encoding building blocks: fixed size numbers are little endian,
+# while strings and lists are prefixed by their length as a varint
+F32 = struct.Struct("<f")
+F64 = struct.Struct("<d")
+
+
+def pack_varint(n: int) -> bytes:
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def pack_str(s: str) -> bytes:
+    b = s.encode()
+    return pack_varint(len(b)) + b
+
+
+# Reads binary encoded fields in order from some bytes
+class Unpacker:
+    def __init__(self, data: bytes, pos: int = 0):
+        self.data = data
+        self.pos = pos
+
+    def at_end(self) -> bool:
+        return self.pos >= len(self.data)
+
+    def byte(self) -> int:
+        self.pos += 1
+        return self.data[self.pos - 1]
+
+    def varint(self) -> int:
+        n = self.data[self.pos]
+        if n < 0x80:  # Fast path for small numbers
+            self.pos += 1
+            return n
+        n, shift = 0, 0
+        while True:
+            b = self.byte()
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                return n
+            shift += 7
+
+    def str(self) -> str:
+        length = self.varint()
+        start, self.pos = self.pos, self.pos + length
+        if self.pos > len(self.data):
+            raise ValueError("Truncated string")
+        return self.data[start:self.pos].decode()
+
+    def struct(self, s: struct.Struct) -> tuple:
+        self.pos += s.size
+        return s.unpack_from(self.data, self.pos - s.size)
+
+
 # Create a signature with a private key for some bytes
 def sign(key: rsa.RSAPrivateKey, data: bytes) -> bytes:
     return key.sign(
@@ -124,6 +507,90 @@ def decrypt(key: rsa.RSAPrivateKey, data: bytes) -> bytes:
 # Nodes communicate using messages which can be sent over TCP or UDP
 # A Message is only a JSON formatted version number and list of MessageItems
 # JSON field names are shrunk to help pack more information into UDP datagrams
+# Peers advertising FEATURE_BINARY can instead use the more compact binary
+# encoding: BINARY_MAGIC followed by each item's type byte and its fields
+
+# Optional record of when a sampled GetItem or SetItem passed through each
+# node, travelling with the item so that its recipient can break down where
+# the time went (see Node.on_trace)
+# Traced items are always sent JSON encoded, whose "x" field older peers
+# ignore (and forward without), so the binary encoding never carries traces
+# Timestamps are each node's own clock, so are only as good as its sync
+class Trace:
+    class Hop:
+        __slots__ = ("node", "arrived", "queued", "sent", "next", "failed")
+
+        def __init__(
+                self, node: str, arrived: float,
+                queued: Optional[float] = None, sent: Optional[float] = None,
+                next: Optional[str] = None, failed: Optional[List[str]] = None):
+            self.node = node  # Random node ID
+            self.arrived = arrived
+            self.queued = queued  # First queued towards a next hop
+            self.sent = sent  # Last attempt at sending to the next hop
+            self.next = next  # Next hop of that attempt as "host:port"
+            self.failed = [] if failed is None else failed  # Earlier ones
+
+        def to_list(self) -> list:
+            return [
+                self.node, self.arrived, self.queued, self.sent, self.next,
+                self.failed]
+
+        # Whether every field has a type this hop could have been sent with
+        def is_valid(self) -> bool:
+            def is_time(t) -> bool:
+                return type(t) in (int, float)
+
+            def is_optional(t, check) -> bool:
+                return t is None or check(t)
+
+            return isinstance(self.node, str) and is_time(self.arrived) \
+                and is_optional(self.queued, is_time) \
+                and is_optional(self.sent, is_time) \
+                and is_optional(self.next, lambda n: isinstance(n, str)) \
+                and isinstance(self.failed, list) \
+                and all(isinstance(f, str) for f in self.failed)
+
+    def __init__(self, id: str, hops: List["Trace.Hop"]):
+        self.id = id
+        self.hops = hops
+
+    def to_dict(self) -> dict:
+        return {"i": self.id, "h": [hop.to_list() for hop in self.hops]}
+
+    @staticmethod
+    def from_dict(d: Optional[dict]) -> Optional["Trace"]:
+        if d is None:
+            return None
+        try:
+            trace = Trace(d["i"], [Trace.Hop(*hop) for hop in d["h"]])
+        except TypeError:
+            raise ValueError("Malformed trace")
+        if not isinstance(trace.id, str) or len(trace.hops) == 0 \
+                or not all(hop.is_valid() for hop in trace.hops):
+            raise ValueError("Malformed trace")
+        return trace
+
+    # A copy whose latest hop can be stamped independently of this one
+    def fork(self) -> "Trace":
+        last = self.hops[-1]
+        return Trace(self.id, self.hops[:-1] + [Trace.Hop(
+            last.node, last.arrived, last.queued, last.sent, last.next,
+            list(last.failed))])
+
+    # Per-hop breakdown in seconds: how long each node held the item before
+    # sending it on, and how long it then took to arrive at the next node
+    def breakdown(self) -> List[dict]:
+        hops = []
+        for i, hop in enumerate(self.hops):
+            d = dict(zip(Trace.Hop.__slots__, hop.to_list()))
+            if hop.sent is not None:
+                d["held"] = hop.sent - hop.arrived
+                if i + 1 < len(self.hops):
+                    d["transit"] = self.hops[i + 1].arrived - hop.sent
+            hops.append(d)
+        return hops
+
 
 # This class is just define a common type between MessageItems
 class MessageItem(ABC):
@@ -136,26 +603,56 @@ class MessageItem(ABC):
     def from_dict(d: dict) -> "MessageItem":
         ...
 
+    @abstractmethod
+    def to_binary(self) -> bytes:
+        ...
+
+    @staticmethod
+    @abstractmethod
+    def from_binary(u: Unpacker) -> "MessageItem":
+        ...
+
 
 # Lets other nodes know what time your End Of Life (EOL) is
 # Without further PeerItems, you will be forgotten from the network after EOL
 # As such, these should be broadcasted over UDP at regular intervals before EOL
+# The optional random node ID lets a node recognise its own broadcasts without
+# resolving addresses, and the optional features bitmask lists the FEATURES
+# the node supports (older peers omit both and ignore them)
 class PeerItem(MessageItem):
-    def __init__(self, eol: float):
+    def __init__(
+            self, eol: float, node: Optional[str] = None, features: int = 0):
         self.eol = eol
-        self.timer: Optional[Task] = None  # Used internal within nodes to timeout entry
+        self.node = node
+        self.features = features
+        self.timer: Optional[Timer] = None  # Used internal within nodes to timeout entry
 
     def to_dict(self) -> dict:
-        return {
+        d = {
             "t": "p",
             "e": self.eol,
         }
+        if self.node is not None:
+            d["n"] = self.node
+        if self.features != 0:
+            d["f"] = self.features
+        return d
 
     @staticmethod
     def from_dict(d: dict):
         if d["t"] != "p":
             raise ValueError("Not a peer message item")
-        return PeerItem(d["e"])
+        return PeerItem(d["e"], d.get("n"), d.get("f", 0))
+
+    def to_binary(self) -> bytes:
+        return b"p" + F64.pack(self.eol) + pack_varint(self.features) \
+            + pack_str(self.node or "")
+
+    @staticmethod
+    def from_binary(u: Unpacker):
+        eol, = u.struct(F64)
+        features = u.varint()
+        return PeerItem(eol, u.str() or None, features)
 
 
 # Tells other nodes about clients you know about and the route score
@@ -172,7 +669,7 @@ class AdvertItem(MessageItem):
         self.score = score
         self.ttp = ttp
         self.eol = eol
-        self.timer: Optional[Task] = None  # Used internal within nodes to timeout entry
+        self.timer: Optional[Timer] = None  # Used internal within nodes to timeout entry
 
     def to_dict(self) -> dict:
         return {
@@ -190,6 +687,21 @@ class AdvertItem(MessageItem):
             raise ValueError("Not an advert message item")
         return AdvertItem(d["c"], d["l"], d["s"], d["p"], d["e"])
 
+    BINARY = struct.Struct("<ffd")  # Score, TTP, EOL
+
+    def to_binary(self) -> bytes:
+        return b"a" + pack_str(self.client) \
+            + pack_varint(len(self.labels)) \
+            + b"".join(pack_str(label) for label in self.labels) \
+            + AdvertItem.BINARY.pack(self.score, self.ttp, self.eol)
+
+    @staticmethod
+    def from_binary(u: Unpacker):
+        client = u.str()
+        labels = [u.str() for _ in range(u.varint())]
+        score, ttp, eol = u.struct(AdvertItem.BINARY)
+        return AdvertItem(client, labels, score, ttp, eol)
+
 
 # An expression of interest in data of some label published after some time
 # Is pushed towards known clients who have listed the label as one they publish
@@ -199,16 +711,18 @@ class AdvertItem(MessageItem):
 class GetItem(MessageItem):
     def __init__(
             self, client: str, label: str,
-            after: float, ttp: float, eol: float):
+            after: float, ttp: float, eol: float,
+            trace: Optional[Trace] = None):
         self.client = client
         self.label = label
         self.after = after
         self.ttp = ttp
         self.eol = eol
-        self.timer = None  # Used internal within nodes to timeout entry
+        self.trace = trace
+        self.timer: Optional[Timer] = None  # Used internal within nodes to timeout entry
 
     def to_dict(self) -> dict:
-        return {
+        d = {
             "t": "g",
             "c": self.client,
             "l": self.label,
@@ -216,42 +730,91 @@ class GetItem(MessageItem):
             "p": self.ttp,
             "e": self.eol,
         }
+        if self.trace is not None:
+            d["x"] = self.trace.to_dict()
+        return d
 
     @staticmethod
     def from_dict(d: dict):
         if d["t"] != "g":
             raise ValueError("Not a get request message item")
-        return GetItem(d["c"], d["l"], d["a"], d["p"], d["e"])
+        return GetItem(
+            d["c"], d["l"], d["a"], d["p"], d["e"], Trace.from_dict(d.get("x")))
+
+    BINARY = struct.Struct("<dfd")  # After, TTP, EOL
+
+    def to_binary(self) -> bytes:
+        return b"g" + pack_str(self.client) + pack_str(self.label) \
+            + GetItem.BINARY.pack(self.after, self.ttp, self.eol)
+
+    @staticmethod
+    def from_binary(u: Unpacker):
+        client = u.str()
+        label = u.str()
+        after, ttp, eol = u.struct(GetItem.BINARY)
+        return GetItem(client, label, after, ttp, eol)
 
 
 # Request to cache and propagate the contained data towards interested clients
 # Time To Propagate (TTP) demands that nodes wait no more than TTP seconds
 # before propagating this SetItem towards subscribers (due to batching reasons)
+# The optional max age asks nodes to forget the data that many seconds after
+# it was published (older peers omit it and ignore it)
 class SetItem(MessageItem):
     def __init__(
             self, label: str, data: Optional[str],
-            at: float, dst: List[Tuple[float, str]]):
+            at: float, dst: List[Tuple[float, str]],
+            max_age: Optional[float] = None, trace: Optional[Trace] = None):
         self.label = label
         self.data = data
         self.at = at
         self.dst = dst
+        self.max_age = max_age
+        self.trace = trace
         # Used internal within nodes to allow .get() to always return new data
         self.last: float = 0
         self.fulfil: Optional[Future] = None
 
     def to_dict(self) -> dict:
-        return {
+        d = {
             "t": "s",
             "l": self.label,
             "d": self.data,
             "a": self.at,
             "c": self.dst,
         }
+        if self.max_age is not None:
+            d["m"] = self.max_age
+        if self.trace is not None:
+            d["x"] = self.trace.to_dict()
+        return d
 
     def from_dict(d: dict):
         if d["t"] != "s":
             raise ValueError("Not a set request message item")
-        return SetItem(d["l"], d["d"], d["a"], d["c"])
+        return SetItem(
+            d["l"], d["d"], d["a"], d["c"], d.get("m"),
+            Trace.from_dict(d.get("x")))
+
+    # Flags byte marks which optional fields follow: 1 data, 2 max age
+    def to_binary(self) -> bytes:
+        flags = (self.data is not None) | (self.max_age is not None) << 1
+        return b"s" + pack_str(self.label) + bytes([flags]) \
+            + (b"" if self.data is None else pack_str(self.data)) \
+            + F64.pack(self.at) \
+            + (b"" if self.max_age is None else F32.pack(self.max_age)) \
+            + pack_varint(len(self.dst)) + b"".join(
+                F32.pack(ttp) + pack_str(client) for ttp, client in self.dst)
+
+    @staticmethod
+    def from_binary(u: Unpacker):
+        label = u.str()
+        flags = u.byte()
+        data = u.str() if flags & 1 else None
+        at, = u.struct(F64)
+        max_age = u.struct(F32)[0] if flags & 2 else None
+        dst = [(u.struct(F32)[0], u.str()) for _ in range(u.varint())]
+        return SetItem(label, data, at, dst, max_age)
 
 
 # The data structure passed between nodes on the network in JSON format
@@ -272,11 +835,35 @@ class Message:
         t_map = {"p": PeerItem, "a": AdvertItem, "g": GetItem, "s": SetItem}
         return Message([t_map[item["t"]].from_dict(item) for item in d["i"]])
 
-    def to_bytes(self) -> bytes:
+    def to_bytes(self, binary: bool = False) -> bytes:
+        if binary:
+            return Message.join([item.to_binary() for item in self.items], True)
         return encode(self.to_dict())
 
     def from_bytes(data: bytes):
-        return Message.from_dict(decode(data))
+        if data[:1] != BINARY_MAGIC:
+            return Message.from_dict(decode(data))
+        t_map = {
+            ord("p"): PeerItem, ord("a"): AdvertItem,
+            ord("g"): GetItem, ord("s"): SetItem}
+        u = Unpacker(data, len(BINARY_MAGIC))
+        items = []
+        try:
+            while not u.at_end():
+                items.append(t_map[u.byte()].from_binary(u))
+        except (IndexError, struct.error):
+            raise ValueError("Truncated binary message")
+        return Message(items)
+
+    # Assemble message bytes from items each already encoded with encode()
+    # (or to_binary() if binary) without re-encoding them, producing exactly
+    # the same bytes as to_bytes()
+    @staticmethod
+    def join(parts: List[bytes], binary: bool = False) -> bytes:
+        if binary:
+            return BINARY_MAGIC + b"".join(parts)
+        return b'{"v":"' + VERSION.encode() + b'","i":[' \
+            + b",".join(parts) + b"]}"
 
 
 # Groups are defined by clients which possess the current group key
@@ -294,6 +881,882 @@ class Group:
         self.at: float = 0
 
 
+# Stores the latest SetItem published to each label this node has seen
+# Can be bounded by item count and (approximate) bytes, evicting the least
+# recently used items except those a local Node.get() is waiting on
+# Items older than their own max age (or the store's default) are dropped
+# Kept entirely in memory, subclass to change where content lives
+class ContentStore:
+    def __init__(
+            self, max_items: Optional[int] = None,
+            max_bytes: Optional[int] = None,
+            max_age: Optional[float] = None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.items: OrderedDict[str, SetItem] = OrderedDict()  # LRU order
+        self.sizes: Dict[str, int] = {}  # Label>Approximate bytes
+        self.bytes = 0
+        self.task: Optional[Task] = None
+
+        # Counters for monitoring how effective the store is
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __contains__(self, label: str) -> bool:
+        return self.lookup(label) is not None
+
+    def __getitem__(self, label: str) -> SetItem:
+        item = self.lookup(label)
+        if item is None:
+            raise KeyError(label)
+        return item
+
+    def __setitem__(self, label: str, item: SetItem):
+        self.remember(label, item)
+        self.shrink()
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    # Look up the content of a label, counting it as a hit or miss
+    def get(self, label: str) -> Optional[SetItem]:
+        item = self.lookup(label)
+        if item is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return item
+
+    def lookup(self, label: str) -> Optional[SetItem]:
+        item = self.items.get(label)
+        if item is None:
+            return None
+        if self.is_stale(item, clock()):
+            self.discard(label)
+            self.expirations += 1
+            return None
+        self.items.move_to_end(label)
+        return item
+
+    # Keep an item in memory as the most recently used
+    def remember(self, label: str, item: SetItem):
+        size = len(label) + len(item.data or "") + 64
+        self.bytes += size - self.sizes.get(label, 0)
+        self.sizes[label] = size
+        self.items[label] = item
+        self.items.move_to_end(label)
+
+    # Drop an item from memory
+    def forget(self, label: str):
+        del self.items[label]
+        self.bytes -= self.sizes.pop(label)
+
+    # Drop an item entirely
+    def discard(self, label: str):
+        if label in self.items:
+            self.forget(label)
+
+    # Make room for newer items by dropping this one
+    def evict(self, label: str):
+        self.discard(label)
+        self.evictions += 1
+
+    def is_pending(self, item: SetItem) -> bool:
+        return item.fulfil is not None and not item.fulfil.done()
+
+    def is_pinned(self, item: SetItem) -> bool:
+        return self.is_pending(item)
+
+    def is_stale(self, item: SetItem, now: float) -> bool:
+        max_age = item.max_age if item.max_age is not None else self.max_age
+        return max_age is not None and item.at + max_age < now \
+            and not self.is_pending(item)
+
+    # Evict least recently used items until within budget again
+    def shrink(self):
+        count, size = len(self.items), self.bytes
+
+        def is_over() -> bool:
+            return (self.max_items is not None and count > self.max_items) \
+                or (self.max_bytes is not None and size > self.max_bytes)
+
+        victims = []
+        for label, item in self.items.items():
+            if not is_over():
+                break
+            if not self.is_pinned(item):
+                victims.append(label)
+                count -= 1
+                size -= self.sizes[label]
+        for label in victims:
+            self.evict(label)
+
+    # Drop every stale item, which is done regularly in the background
+    def sweep(self):
+        now = clock()
+        stale = [
+            label for label, item in self.items.items()
+            if self.is_stale(item, now)]
+        for label in stale:
+            self.discard(label)
+        self.expirations += len(stale)
+
+    # Load any stored content and start background work (see Node.start)
+    async def start(self):
+        async def do_regular_sweeps():
+            while True:
+                await asyncio.sleep(STORE_SWEEP)
+                self.sweep()
+
+        self.task = asyncio.create_task(do_regular_sweeps())
+
+    # Stop any background work and release resources
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+# Persists content in a directory of append-only segment files so that it
+# survives restarts, with only an index and a hot tier kept in memory
+# Records are length prefixed binary SetItems, read back through mmap
+# Sealed segments are compacted in the background once mostly superseded
+# The memory budget applies to the hot tier: items evicted from it are only
+# dropped from memory, except those with local state (see Node.get)
+class DiskContentStore(ContentStore):
+    def __init__(
+            self, path: str, hot: int = 256,
+            max_bytes: Optional[int] = None,
+            max_age: Optional[float] = None,
+            segment_size: int = SEGMENT_SIZE):
+        super().__init__(hot, max_bytes, max_age)
+        self.log = logging.getLogger(__name__)
+        self.path = path
+        self.segment_size = segment_size
+        self.index: Dict[str, Tuple[int, int, int, float]] = {}  # Label>Record
+        self.segments: Dict[int, int] = {}  # Segment>Bytes written
+        self.live: Dict[int, int] = {}  # Segment>Bytes still indexed
+        self.maps: Dict[int, mmap.mmap] = {}
+        self.active: Optional[int] = None  # Segment being appended to
+        self.file = None
+        self.compact_task: Optional[Task] = None
+
+    def __contains__(self, label: str) -> bool:
+        if label in self.items:
+            return super().__contains__(label)
+        return label in self.index and self.index[label][3] >= clock()
+
+    def __setitem__(self, label: str, item: SetItem):
+        if item.data is not None or item.at != 0:  # Skip Node.get placeholders
+            self.append(label, item)
+        super().__setitem__(label, item)
+
+    def __len__(self) -> int:
+        return len(self.index.keys() | self.items.keys())
+
+    def lookup(self, label: str) -> Optional[SetItem]:
+        if label in self.items or label not in self.index:
+            return super().lookup(label)
+        if self.index[label][3] < clock():
+            self.discard(label)
+            self.expirations += 1
+            return None
+        item = self.read(*self.index[label][:3])
+        self.remember(label, item)
+        self.shrink()
+        return item
+
+    def discard(self, label: str):
+        super().discard(label)
+        if label in self.index:
+            seg, _, length, _ = self.index.pop(label)
+            self.live[seg] -= 4 + length
+
+    # Items which are still on disk only need to be dropped from memory
+    def evict(self, label: str):
+        if label in self.index:
+            self.forget(label)
+        else:
+            super().evict(label)
+
+    def is_pinned(self, item: SetItem) -> bool:
+        return item.last != 0 or super().is_pinned(item)
+
+    def sweep(self):
+        super().sweep()
+        now = clock()
+        stale = [
+            label for label, (_, _, _, expiry) in self.index.items()
+            if expiry < now and label not in self.items]
+        for label in stale:
+            self.discard(label)
+        self.expirations += len(stale)
+
+    def segment(self, seg: int) -> str:
+        return os.path.join(self.path, f"{seg:08}.seg")
+
+    # When a record should be dropped from the index
+    def expiry(self, item: SetItem) -> float:
+        max_age = item.max_age if item.max_age is not None else self.max_age
+        return math.inf if max_age is None else item.at + max_age
+
+    def read(self, seg: int, pos: int, length: int) -> SetItem:
+        m = self.maps.get(seg)
+        if m is None or len(m) < pos + length:
+            if m is not None:
+                m.close()
+            with open(self.segment(seg), "rb") as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[seg] = m
+        return SetItem.from_binary(Unpacker(m[pos:pos + length], 1))
+
+    def append(self, label: str, item: SetItem):
+        if self.file is None \
+                or self.segments[self.active] >= self.segment_size:
+            self.roll()
+        record = SetItem(
+            label, item.data, item.at, [], item.max_age).to_binary()
+        self.file.write(struct.pack("<I", len(record)) + record)
+        if label in self.index:
+            seg, _, length, _ = self.index[label]
+            self.live[seg] -= 4 + length
+        pos = self.segments[self.active] + 4
+        self.index[label] = (self.active, pos, len(record), self.expiry(item))
+        self.segments[self.active] += 4 + len(record)
+        self.live[self.active] += 4 + len(record)
+
+    # Seal the active segment and start appending to a new one
+    def roll(self):
+        if self.file is not None:
+            self.file.close()
+        self.active = max(self.segments, default=0) + 1
+        self.segments[self.active] = 0
+        self.live[self.active] = 0
+        self.file = open(self.segment(self.active), "ab", buffering=0)
+
+    # Rebuild the index from every segment, keeping the newest of each label
+    # Torn records at the end of a segment (from a crash) are truncated away
+    def load(self):
+        os.makedirs(self.path, exist_ok=True)
+        latest: Dict[str, Tuple[float, int, int, int, float]] = {}
+        segs = sorted(
+            int(name[:-4]) for name in os.listdir(self.path)
+            if name.endswith(".seg") and name[:-4].isdigit())
+        for seg in segs:
+            with open(self.segment(seg), "r+b") as f:
+                size = os.fstat(f.fileno()).st_size
+                pos = 0
+                if size != 0:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                        while pos + 4 <= size:
+                            length, = struct.unpack_from("<I", m, pos)
+                            if pos + 4 + length > size:
+                                break
+                            try:
+                                u = Unpacker(m[pos + 4:pos + 4 + length], 1)
+                                item = SetItem.from_binary(u)
+                            except (ValueError, IndexError, struct.error):
+                                break
+                            if item.label not in latest \
+                                    or item.at >= latest[item.label][0]:
+                                latest[item.label] = (
+                                    item.at, seg, pos + 4, length,
+                                    self.expiry(item))
+                            pos += 4 + length
+                if pos != size:
+                    self.log.warning("Truncated torn segment %s", seg)
+                    f.truncate(pos)
+            self.segments[seg] = pos
+            self.live[seg] = 0
+        for label, (_, seg, pos, length, expiry) in latest.items():
+            self.index[label] = (seg, pos, length, expiry)
+            self.live[seg] += 4 + length
+
+    async def start(self):
+        await asyncio.to_thread(self.load)
+        self.log.info(
+            "Loaded %s labels from content store %s", len(self.index), self.path)
+        await super().start()
+
+        async def do_regular_compactions():
+            while True:
+                await asyncio.sleep(COMPACT_INTERVAL)
+                try:
+                    await self.compact()
+                except OSError as e:
+                    self.log.warning("Error compacting content store: %s", e)
+
+        self.compact_task = asyncio.create_task(do_regular_compactions())
+
+    def stop(self):
+        super().stop()
+        if self.compact_task is not None:
+            self.compact_task.cancel()
+            self.compact_task = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        for m in self.maps.values():
+            m.close()
+        self.maps = {}
+
+    # Copy the still indexed records of sealed segments into a new segment
+    # once at least half of their bytes have been superseded
+    async def compact(self):
+        sealed = [seg for seg in self.segments if seg != self.active]
+        total = sum(self.segments[seg] for seg in sealed)
+        live = sum(self.live[seg] for seg in sealed)
+        if len(sealed) == 0 or total == live or (total - live) * 2 < total:
+            return  # Nothing to reclaim, or not yet worth rewriting
+        moves = [
+            (label, loc) for label, loc in self.index.items()
+            if loc[0] in sealed]
+        if len(moves) == 0:
+            self.remove_segments(sealed)
+            self.log.info(
+                "Removed %s segments (%s bytes) of garbage", len(sealed), total)
+            return
+        target = max(self.segments) + 1
+        self.segments[target] = 0
+        self.live[target] = 0
+
+        # Copying happens in another thread, so records may be superseded
+        def copy() -> List[Tuple[int, int, int, float]]:
+            locs = []
+            files = {}
+            try:
+                with open(self.segment(target), "wb") as out:
+                    for _, (seg, pos, length, expiry) in moves:
+                        if seg not in files:
+                            files[seg] = open(self.segment(seg), "rb")
+                        files[seg].seek(pos - 4)
+                        out.write(files[seg].read(4 + length))
+                        pos = self.segments[target] + 4
+                        locs.append((target, pos, length, expiry))
+                        self.segments[target] += 4 + length
+                    out.flush()
+                    os.fsync(out.fileno())
+            finally:
+                for f in files.values():
+                    f.close()
+            return locs
+
+        locs = await asyncio.to_thread(copy)
+        for (label, old), new in zip(moves, locs):
+            if self.index.get(label) == old:
+                self.index[label] = new
+                self.live[target] += 4 + new[2]
+        self.remove_segments(sealed)
+        self.log.info(
+            "Compacted %s segments (%s bytes) into %s bytes",
+            len(sealed), total, self.segments[target])
+
+    def remove_segments(self, segs: List[int]):
+        for seg in segs:
+            if seg in self.maps:
+                self.maps.pop(seg).close()
+            del self.segments[seg]
+            del self.live[seg]
+            os.remove(self.segment(seg))
+
+
+# Counters and histograms served in the Prometheus text format
+# Samples are identified by a metric name and a tuple of label pairs, so that
+# recording one is a dictionary update cheap enough to always leave on
+class Metrics:
+    Labels = Tuple[Tuple[str, str], ...]
+
+    # Cumulative counts of observations at or below each bucket bound
+    class Histogram:
+        __slots__ = ("bounds", "counts", "sum", "count")
+
+        def __init__(self, bounds: Tuple[float, ...]):
+            self.bounds = bounds
+            self.counts = [0] * len(bounds)
+            self.sum = 0.0
+            self.count = 0
+
+        def observe(self, value: float):
+            i = bisect.bisect_left(self.bounds, value)
+            if i < len(self.counts):
+                self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def __init__(self):
+        self.help: Dict[str, Tuple[str, str]] = {}  # Name>Type+Description
+        self.counters: Dict[str, Dict["Metrics.Labels", float]] = {}
+        self.histograms: Dict[
+            str, Dict["Metrics.Labels", "Metrics.Histogram"]] = {}
+        self.buckets: Dict[str, Tuple[float, ...]] = {}
+
+    # Metrics are declared once up front so that they are always exported
+    def counter(self, name: str, description: str):
+        self.help[name] = ("counter", description)
+        self.counters[name] = {}
+
+    def histogram(
+            self, name: str, description: str, buckets: Tuple[float, ...]):
+        self.help[name] = ("histogram", description)
+        self.histograms[name] = {}
+        self.buckets[name] = buckets
+
+    def inc(self, name: str, labels: "Metrics.Labels" = (), value: float = 1):
+        counter = self.counters[name]
+        counter[labels] = counter.get(labels, 0) + value
+
+    def observe(self, name: str, value: float, labels: "Metrics.Labels" = ()):
+        histogram = self.histograms[name].get(labels)
+        if histogram is None:
+            histogram = Metrics.Histogram(self.buckets[name])
+            self.histograms[name][labels] = histogram
+        histogram.observe(value)
+
+    # Export everything recorded plus some values only read when scraped,
+    # given as name>(type, description, [(labels, value)])
+    def render(self, extra: Dict[str, tuple]) -> str:
+        lines = []
+
+        def sample(name: str, labels: Metrics.Labels, value: float):
+            if len(labels) == 0:
+                lines.append(f"{name} {value}")
+                return
+            pairs = ",".join(f'{k}="{v}"' for k, v in labels)
+            lines.append(f"{name}{{{pairs}}} {value}")
+
+        for name, (kind, description) in self.help.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in self.counters.get(name, {}).items():
+                sample(name, labels, value)
+            for labels, histogram in self.histograms.get(name, {}).items():
+                total = 0
+                for bound, count in zip(histogram.bounds, histogram.counts):
+                    total += count
+                    sample(f"{name}_bucket", labels + (("le", bound),), total)
+                sample(
+                    f"{name}_bucket", labels + (("le", "+Inf"),),
+                    histogram.count)
+                sample(f"{name}_sum", labels, histogram.sum)
+                sample(f"{name}_count", labels, histogram.count)
+        for name, (kind, description, samples) in extra.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                sample(name, labels, value)
+        return "\n".join(lines) + "\n"
+
+
+# Sampling profiler for the thread running the event loop
+# A background thread periodically records the loop thread's current stack,
+# so the loop is only slowed down by the GIL being taken for each sample
+# Stacks are counted in the collapsed format understood by flame graph tools
+class Sampler:
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self.thread_id = threading.get_ident()  # Created on the loop thread
+        self.stacks: Dict[str, int] = {}  # Outermost;...;innermost>Samples
+        self.samples = 0
+        self.idle = 0  # Samples of the loop waiting for events
+
+    def sample(self, stop: threading.Event):
+        while not stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                return
+            if frame.f_code.co_name == "select":
+                self.idle += 1
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                name = os.path.basename(code.co_filename)
+                stack.append(f"{name}:{code.co_name}")
+                frame = frame.f_back
+            key = ";".join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    # Sample for some seconds without blocking the loop, returning the report
+    async def run(self, seconds: float) -> str:
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self.sample, args=(stop,), daemon=True)
+        thread.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            stop.set()
+        thread.join()
+        return self.report()
+
+    def report(self) -> str:
+        lines = [
+            f"# {self.samples} samples every {self.interval}s, "
+            f"{self.idle} waiting for events"]
+        for stack, count in sorted(
+                self.stacks.items(), key=lambda s: s[1], reverse=True):
+            lines.append(f"{stack} {count}")
+        return "\n".join(lines) + "\n"
+
+
+# A persistent TCP connection to a peer carrying length prefixed messages
+class Connection:
+    def __init__(self, reader: StreamReader, writer: StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.lock = asyncio.Lock()  # Keeps concurrent drains in order
+        self.timer: Optional[Timer] = None  # Closes the connection when idle
+        self.acks: deque = deque()  # Futures of unacked messages, oldest first
+        self.task: Optional[Task] = None  # Reads acknowledgements
+
+    def is_open(self) -> bool:
+        return not self.writer.is_closing() and not self.reader.at_eof()
+
+
+# Lets concurrent attempts at delivering the same items agree on one winner
+# Each attempt claims the race once connected, before writing anything, so
+# the items are only ever delivered along one route
+class Race:
+    def __init__(self):
+        self.winner: Optional[Addr] = None
+
+    def claim(self, addr: Addr) -> bool:
+        if self.winner is None:
+            self.winner = addr
+        return self.winner == addr
+
+
+# Smoothed measurements of how well sending to a peer has been going
+# Peers which are slow, failing or backed up become more costly to route via
+# Penalties fade while unused so that a recovered peer is eventually retried
+class PeerCost:
+    def __init__(self):
+        self.latency = 0.0  # Seconds per batch sent
+        self.failure = 0.0  # Fraction of batches which failed
+        self.depth = 0.0  # Items per batch sent
+        self.at = clock()  # Time of last sample
+
+    def sample(self, latency: float, failure: bool, depth: int):
+        self.decay()
+        alpha = ROUTE_COST_ALPHA
+        self.latency += alpha * (latency - self.latency)
+        self.failure += alpha * ((1 if failure else 0) - self.failure)
+        self.depth += alpha * (depth - self.depth)
+
+    def decay(self):
+        now = clock()
+        factor = 0.5 ** ((now - self.at) / ROUTE_COST_HALF_LIFE)
+        self.latency *= factor
+        self.failure *= factor
+        self.depth *= factor
+        self.at = now
+
+    def cost(self) -> float:
+        self.decay()
+        latency = max(0, self.latency - ROUTE_COST_MIN_LATENCY)
+        depth = max(0, self.depth - ROUTE_COST_MIN_DEPTH)
+        return 1 \
+            + ROUTE_COST_LATENCY * latency \
+            + ROUTE_COST_FAILURE * self.failure \
+            + ROUTE_COST_QUEUE * depth
+
+    def __str__(self) -> str:
+        return (
+            f"cost={self.cost():.2f} latency={self.latency * 1000:.1f}ms "
+            f"failure={self.failure:.2f} depth={self.depth:.1f}")
+
+
+# Circuit breaker tracking whether a peer is currently worth sending to
+# Closed: in use. Open: skipped after repeated failures until a probe is due.
+# Half-open: skipped while a background probe checks if it has recovered
+class Breaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self):
+        self.state = Breaker.CLOSED
+        self.failures = 0  # Consecutive failed sends or probes
+        self.reset = BREAKER_RESET  # Seconds to stay open before probing
+        self.timer: Optional[Timer] = None  # Starts the next probe
+        self.probe_at: float = 0  # When the next probe starts
+
+    def is_closed(self) -> bool:
+        return self.state == Breaker.CLOSED
+
+    def success(self):
+        self.state = Breaker.CLOSED
+        self.failures = 0
+        self.reset = BREAKER_RESET
+
+    # Returns True if the breaker has just opened
+    def failure(self) -> bool:
+        self.failures += 1
+        if self.state == Breaker.HALF_OPEN:
+            self.state = Breaker.OPEN
+            self.reset = min(self.reset * 2, BREAKER_MAX_RESET)
+            return True
+        if self.state == Breaker.CLOSED \
+                and self.failures >= BREAKER_FAILURES:
+            self.state = Breaker.OPEN
+            return True
+        return False
+
+    def __str__(self) -> str:
+        return f"circuit={self.state} failures={self.failures}"
+
+
+# Adverts waiting to be broadcast, holding at most one per client
+# Adverts for a client which is already pending are coalesced into one,
+# keeping the newest advert and the earliest deadline
+# Queued adverts are shared with the client table, so are never modified here
+# Superseded deadlines are left in the heap and skipped when popped
+class BroadcastQueue:
+    def __init__(self, cooldown: float = ADVERT_COOLDOWN):
+        self.cooldown = cooldown
+        self.pending: Dict[str, Tuple[float, int, AdvertItem]] = {}  # ID>Entry
+        self.heap: List[Tuple[float, int, str]] = []
+        self.seq = itertools.count()
+        self.sent: Dict[str, float] = {}  # ID>Last broadcast time
+        self.coalesced = 0  # Adverts merged into an already pending one
+        self.deferred = 0  # Adverts held back by the cooldown
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def push(self, deadline: float, advert: AdvertItem):
+        cooldown = self.sent.get(advert.client, -math.inf) + self.cooldown
+        if cooldown > deadline:
+            deadline = cooldown
+            self.deferred += 1
+        if advert.client in self.pending:
+            old_deadline, seq, old = self.pending[advert.client]
+            if old.eol > advert.eol:
+                advert = old
+            self.coalesced += 1
+            if old_deadline <= deadline:
+                self.pending[advert.client] = (old_deadline, seq, advert)
+                return
+        seq = next(self.seq)
+        self.pending[advert.client] = (deadline, seq, advert)
+        heapq.heappush(self.heap, (deadline, seq, advert.client))
+
+    # Earliest deadline of any pending advert
+    def deadline(self) -> Optional[float]:
+        while len(self.heap) != 0:
+            deadline, seq, client = self.heap[0]
+            if client in self.pending and self.pending[client][1] == seq:
+                return deadline
+            heapq.heappop(self.heap)
+        return None
+
+    # Remove and return the pending advert with the earliest deadline
+    def pop(self) -> Optional[Tuple[float, AdvertItem]]:
+        if self.deadline() is None:
+            return None
+        deadline, _, client = heapq.heappop(self.heap)
+        return deadline, self.pending.pop(client)[2]
+
+    # Record that an advert for client has just been broadcast
+    def mark_sent(self, client: str, at: float):
+        if self.cooldown > 0:
+            self.sent[client] = at
+
+    def forget(self, client: str):
+        self.sent.pop(client, None)
+
+
+# Routes towards one client through each peer, kept ordered best score first
+class Routes:
+    def __init__(self):
+        self.scores: Dict[Addr, float] = {}  # Peer>Score
+        self.order: List[Tuple[float, Addr]] = []  # Sorted (-score, peer)
+        self.cache: Optional[List[Addr]] = None
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    def update(self, addr: Addr, score: float):
+        self.remove(addr)
+        self.scores[addr] = score
+        bisect.insort(self.order, (-score, addr))
+        self.cache = None
+
+    def remove(self, addr: Addr):
+        if addr in self.scores:
+            idx = bisect.bisect_left(self.order, (-self.scores.pop(addr), addr))
+            del self.order[idx]
+            self.cache = None
+
+    # Peers to try in order of preference
+    def addrs(self) -> List[Addr]:
+        if self.cache is None:
+            self.cache = [addr for _, addr in self.order]
+        return self.cache
+
+    def best(self) -> Tuple[Addr, float]:
+        score, addr = self.order[0]
+        return addr, -score
+
+
+# Routes towards every known client, with a reverse index of the clients
+# routed through each peer so that losing a peer only touches its routes
+class RouteTable:
+    def __init__(self):
+        self.clients: Dict[str, Routes] = {}  # ID>Routes
+        self.via: Dict[Addr, Set[str]] = {}  # Peer>IDs
+
+    def __contains__(self, client: str) -> bool:
+        return client in self.clients
+
+    def __getitem__(self, client: str) -> Routes:
+        return self.clients[client]
+
+    def items(self):
+        return self.clients.items()
+
+    # Peers to try in order of preference to reach client
+    def get(self, client: str) -> List[Addr]:
+        routes = self.clients.get(client)
+        return [] if routes is None else routes.addrs()
+
+    def update(self, client: str, addr: Addr, score: float):
+        if client not in self.clients:
+            self.clients[client] = Routes()
+        self.clients[client].update(addr, score)
+        self.via.setdefault(addr, set()).add(client)
+
+    def remove_peer(self, addr: Addr):
+        for client in self.via.pop(addr, ()):
+            self.clients[client].remove(addr)
+
+    def remove_client(self, client: str):
+        for addr in self.clients.pop(client).scores:
+            self.via[addr].discard(client)
+            if len(self.via[addr]) == 0:
+                del self.via[addr]
+
+
+# Items waiting to be sent to one next hop peer, ordered by deadline
+# Ties are broken by insertion order so MessageItems are never compared
+# A newer item pushed under the same key as a pending one supersedes it,
+# keeping the earliest of their deadlines; superseded heap entries are skipped
+class SendQueue:
+    Entry = Tuple[float, int, Optional[str], List[Addr], MessageItem]
+    Key = Tuple
+
+    def __init__(self):
+        self.heap: List[Tuple[float, int, SendQueue.Key]] = []
+        self.entries: Dict[SendQueue.Key, SendQueue.Entry] = {}
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    # Key under which an item supersedes older ones: the newest value of a
+    # label for a destination client, or the newest interest of a client
+    @staticmethod
+    def key(entry: "SendQueue.Entry") -> "SendQueue.Key":
+        _, seq, client, _, item = entry
+        if type(item) is SetItem:
+            return ("s", item.label, client)
+        if type(item) is GetItem:
+            return ("g", item.label, item.client)
+        return ("", seq)
+
+    # Returns True if the entry was coalesced with a pending one
+    def push(self, entry: "SendQueue.Entry") -> bool:
+        key = SendQueue.key(entry)
+        old = self.entries.get(key)
+        if old is not None:
+            deadline, seq, client, routes, item = entry
+            if type(item) is SetItem and old[4].at > item.at \
+                    or type(item) is GetItem and old[4].eol > item.eol:
+                item = old[4]
+            entry = (min(deadline, old[0]), seq, client, routes, item)
+        self.entries[key] = entry
+        heapq.heappush(self.heap, (entry[0], entry[1], key))
+        return old is not None
+
+    # Remove and return the pending entry under key, if any
+    def take(self, key: "SendQueue.Key") -> Optional["SendQueue.Entry"]:
+        return self.entries.pop(key, None)
+
+    # Earliest deadline of any item in this queue
+    def deadline(self) -> float:
+        while len(self.heap) != 0:
+            deadline, seq, key = self.heap[0]
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] == seq:
+                return deadline
+            heapq.heappop(self.heap)
+        return math.inf
+
+    # Remove and return every item in this queue, earliest deadline first
+    def pop_all(self) -> List["SendQueue.Entry"]:
+        entries = sorted(self.entries.values())
+        self.heap, self.entries = [], {}
+        return entries
+
+
+# Values of a label as they arrive, from one standing interest (see
+# Node.subscribe), read with "async for" until closed
+# Unread values are buffered: only the latest one, or with keep_all up to
+# size of them, after which the oldest are dropped
+class Subscription:
+    def __init__(
+            self, node: "Node", label: str, group: Optional[str],
+            keep_all: bool, size: int):
+        self.node = node
+        self.label = label  # As sent on the network
+        self.group = group
+        self.values: deque = deque(maxlen=size if keep_all else 1)
+        self.dropped = 0  # Values replaced before being read
+        self.after: float = 0  # Publication time of the latest value
+        self.waiter: Optional[Future] = None
+        self.task: Optional[Task] = None  # Keeps our interest alive
+        self.closed = False
+
+    def push(self, s: "SetItem"):
+        if len(self.values) == self.values.maxlen:
+            self.dropped += 1
+        self.values.append(s.data)
+        self.after = max(self.after, s.at)
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def close(self):
+        self.node.unsubscribe(self)
+
+    def __aiter__(self) -> "Subscription":
+        return self
+
+    async def __anext__(self) -> str:
+        while True:
+            while len(self.values) == 0:
+                if self.closed:
+                    raise StopAsyncIteration
+                self.waiter = asyncio.get_running_loop().create_future()
+                await self.waiter
+            data = self.values.popleft()
+            if self.group is None:
+                return data
+            try:
+                data = base64.b64decode(data)
+                return self.node.groups[self.group].key.decrypt(data).decode()
+            except InvalidToken:
+                self.node.log.warning(
+                    "Unable to decrypt group %s data", self.group)
+
+    async def __aenter__(self) -> "Subscription":
+        return self
+
+    async def __aexit__(self, *_):
+        self.close()
+
+
 # Provides all the networking logic for interacting with a network of ICN nodes
 # While many can be listening on many ports on the PI at once, one must serve
 # as the PI master node listening on the default port (33333, which should be
@@ -304,39 +1767,124 @@ class Group:
 # Duplicate names are not fatal but significantly reduce the networks ability
 # to send interests and data to only places that it is needed
 class Node:
-    def __init__(self):
+    def __init__(
+            self,
+            content_store: Optional[ContentStore] = None,
+            advert_cooldown: float = ADVERT_COOLDOWN,
+            race_stagger: Optional[float] = None,
+            network: Optional[Network] = None,
+            trace_every: Optional[int] = None):
+        self.id = os.urandom(4).hex()  # Random per-process node identity
+        self.network = Network() if network is None else network
+        self.tasks: List[Task] = []  # Background tasks stopped by stop()
         self.is_main = None
         self.tcp = None
+        self.peer = None  # Our latest PeerItem, included in all broadcasts
         self.advert = None
         self.dport = None
         self.port = None
         self.udp = None
+        self.interfaces: List[Interface] = []  # Refreshed in the background
+        self.discovery = "broadcast"
+        self.multicast_group = MULTICAST_GROUP
+        self.multicast_interfaces: Optional[List[str]] = None  # Names
+        self.multicast_joined: Set[str] = set()  # Interface addresses
         self.log = logging.getLogger(__name__)
+        self.timers = TimerWheel(self.log)  # Expires peers, clients, interests
         self.peers: Dict[Addr, PeerItem] = {}  # IP>Peer info
         self.clients: Dict[str, AdvertItem] = {}  # ID>Client info
+        self.publishers: Dict[str, Set[str]] = {}  # Label>Publishing client IDs
         self.groups: Dict[str, Group] = {}  # Group name>Group info
         self.interests: Dict[str, Dict[str, GetItem]] = {}  # Label+ID>Interest
-        self.routes: Dict[str, List[Dict]] = {}  # ID>Score+Route
-        # TODO(optimisation): write to/read from disk
-        self.content_store: Dict[str, SetItem] = {}  # Label>data
+        self.routes = RouteTable()  # ID>Score+Route
+        self.content_store = ContentStore() \
+            if content_store is None else content_store  # Label>data
+        self.returned: Dict[str, float] = {}  # Label>Time of value got last
 
         self.batch_broadcast_task = None
-        self.broadcast_queue = queue.PriorityQueue()
+        self.broadcast_queue = BroadcastQueue(advert_cooldown)
         self.is_broadcast_queue_changed = False
 
+        self.costs: Dict[Addr, PeerCost] = {}  # IP>Send statistics
+        self.breakers: Dict[Addr, Breaker] = {}  # IP>Health
+        self.connections: Dict[Addr, Connection] = {}  # Peer>TCP stream
+        self.streams: List[StreamWriter] = []  # Persistent incoming streams
         self.batch_send_task = None
-        self.send_queue = queue.PriorityQueue()
+        self.send_queues: Dict[Optional[Addr], SendQueue] = {}  # Next hop>Items
+        self.send_seq = itertools.count()  # Orders items with equal deadlines
+        self.send_index: Dict[SendQueue.Key, Optional[Addr]] = {}  # Set>Hop
+        self.send_coalesced = 0  # Superseded items dropped from send queues
+        self.race_stagger = race_stagger  # None to only try one route at once
+        self.races = 0  # Batches also sent racing along a second route
+        self.races_won = 0  # Races won by the second route
         self.is_send_queue_changed = False
 
+        # Served on the debug port's /metrics path (see serve_debug)
+        self.metrics = Metrics()
+        self.metrics.counter(
+            "tcdicn_messages_received_total", "Messages received")
+        self.metrics.counter(
+            "tcdicn_bytes_received_total", "Bytes of messages received")
+        self.metrics.counter(
+            "tcdicn_items_received_total", "Message items received")
+        self.metrics.counter(
+            "tcdicn_messages_sent_total", "Messages sent")
+        self.metrics.counter(
+            "tcdicn_bytes_sent_total", "Bytes of messages sent")
+        self.metrics.counter(
+            "tcdicn_items_sent_total", "Message items sent")
+        self.metrics.counter(
+            "tcdicn_connection_failures_total",
+            "Failed attempts to send to a peer")
+        self.metrics.histogram(
+            "tcdicn_batch_items", "Items sent together in one message",
+            METRICS_BATCH_BUCKETS)
+        self.metrics.histogram(
+            "tcdicn_batch_slack_seconds",
+            "Seconds left until each item's deadline when it was sent",
+            METRICS_SLACK_BUCKETS)
+        self.metrics.histogram(
+            "tcdicn_handler_seconds",
+            "Seconds spent in handlers while handler timing is enabled",
+            METRICS_HANDLER_BUCKETS)
+        self.is_timing_handlers = False
+        self.sampler: Optional[Sampler] = None  # While profiling
+        self.metrics.histogram(
+            "tcdicn_loop_lag_seconds",
+            "Seconds the event loop was late waking up while watched",
+            METRICS_LAG_BUCKETS)
+        self.metrics.counter(
+            "tcdicn_loop_stalls_total",
+            "Times the event loop was blocked for too long, by call site")
+        self.heartbeat = 0.0  # Last time the watched loop woke up
+
+        self.trace_every = trace_every  # Trace 1 in N of our gets and sets
+        self.trace_seq = itertools.count()
+        self.traces = deque(maxlen=TRACE_HISTORY)  # Delivered to us
+
+        self.subscriptions: Dict[str, List[Subscription]] = {}  # Label>Subs
+
     # Starts all tasks needed for the node to communicate with the network
     # Send the process a SIGINT or cancel the coroutine to shutdown the node
+    # Peers are discovered by subnet broadcast unless discovery is set to
+    # "multicast", which joins multicast_group on each of multicast_interfaces
+    # (or every interface), or "both", which keeps mixed networks connected
     async def start(
             self, port: int, dport: int,
             ttl: float, tpf: int,
-            client: dict = None):
+            client: dict = None,
+            discovery: str = "broadcast",
+            multicast_group: str = MULTICAST_GROUP,
+            multicast_ttl: int = MULTICAST_TTL,
+            multicast_interfaces: Optional[List[str]] = None):
+        if discovery not in ("broadcast", "multicast", "both"):
+            raise ValueError(f"Unknown discovery mode: {discovery}")
         self.port = port
         self.dport = dport
         self.is_main = (port == dport)
+        self.discovery = discovery
+        self.multicast_group = multicast_group
+        self.multicast_interfaces = multicast_interfaces
 
         # If this is a client node, prepare the advert we regularly send
         self.advert = None if client is None else AdvertItem(
@@ -348,6 +1896,9 @@ class Node:
 
         loop = asyncio.get_running_loop()
 
+        # Reload any content persisted by a previous run
+        await self.content_store.start()
+
         # Wrap UDP handling into self.on_datagram
         class UdpProtocol:
             def connection_made(_, _udp: DatagramTransport):
@@ -363,19 +1914,44 @@ class Node:
                 self.log.warning("UDP transport error: %s", exc)
 
         # Start UDP and TCP server
-        self.udp, _ = await loop.create_datagram_endpoint(
-            lambda: UdpProtocol(),
-            local_addr=("0.0.0.0", self.port),
-            allow_broadcast=True)
-        self.tcp = await asyncio.start_server(
-            self.on_connection, "0.0.0.0", self.port)
+        self.udp = await self.network.listen_udp(
+            lambda: UdpProtocol(), self.port)
+        self.tcp = await self.network.listen_tcp(
+            self.on_connection, self.port)
+        if self.discovery != "broadcast":
+            sock = self.udp.get_extra_info("socket")
+            sock.setsockopt(
+                socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, multicast_ttl)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+
+        # Regularly refresh our interface table without blocking the loop
+        async def refresh_interfaces():
+            try:
+                interfaces = await self.network.interfaces()
+            except OSError as e:
+                self.log.warning("Error listing interfaces: %s", e)
+                return
+            if [i.broadcast for i in interfaces] \
+                    != [i.broadcast for i in self.interfaces]:
+                self.log.info("Broadcasting to: %s", ", ".join(
+                    f"{i.name}={i.network}" for i in interfaces))
+            self.interfaces = interfaces
+            self.join_multicast()
+
+        async def do_regular_interface_refreshes():
+            while True:
+                await asyncio.sleep(INTERFACE_REFRESH)
+                await refresh_interfaces()
+
+        await refresh_interfaces()
 
         # Regularly broadcast own adverts TPF times before our TTL can run out
         async def do_regular_broadcasts():
             while True:
                 try:
                     self.log.debug("Broadcasting to peers...")
-                    items = [PeerItem(time.time() + ttl)]
+                    self.peer = PeerItem(clock() + ttl, self.id, FEATURES)
+                    items = [self.peer]
                     if self.advert is not None:
                         self.advert.eol = items[0].eol
                         items.append(self.advert)
@@ -387,123 +1963,309 @@ class Node:
         # Run in background
         tcp_task = asyncio.create_task(self.tcp.serve_forever())
         reg_task = asyncio.create_task(do_regular_broadcasts())
-        tasks = [tcp_task, reg_task]
+        if_task = asyncio.create_task(do_regular_interface_refreshes())
+        self.tasks = [tcp_task, reg_task, if_task]
 
         # Shutdown if we receive a signal
-        def shutdown():
-            self.log.info("Shutting down...")
-            reg_task.cancel()
-            self.udp.close()
-            self.tcp.close()
-            for group in self.groups:
-                for task in self.groups[group].tasks.values():
-                    task.cancel()
-
         for sig in [signal.SIGHUP, signal.SIGTERM, signal.SIGINT]:
-            loop.add_signal_handler(sig, shutdown)
+            loop.add_signal_handler(sig, self.stop)
 
         # Wait until cancelled or shutdown
         try:
             async with self.tcp:
                 self.log.info("Up and listening on :%s", self.port)
                 self.log.info("Targeting :%s for discovery", self.dport)
-                await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                await asyncio.wait(
+                    self.tasks, return_when=asyncio.FIRST_COMPLETED)
         except asyncio.exceptions.CancelledError:
             self.log.debug("Node tasks cancelled")
+            self.stop()
         self.log.info("Goodbye :)")
 
+    # Stop all networking and background work, causing start() to return
+    def stop(self):
+        self.log.info("Shutting down...")
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        for task in [self.batch_send_task, self.batch_broadcast_task]:
+            if task is not None:
+                task.cancel()
+        self.timers.stop()
+        for connection in self.connections.values():
+            connection.writer.close()
+        for stream in self.streams:
+            stream.close()
+        self.content_store.stop()
+        self.udp.close()
+        self.tcp.close()
+        for group in self.groups:
+            for task in self.groups[group].tasks.values():
+                task.cancel()
+        for subscriptions in list(self.subscriptions.values()):
+            for subscription in list(subscriptions):
+                self.unsubscribe(subscription)
+
     # Subscribes to label and returns first new value received
     # Repeats request every TTL/TPF seconds until successful or cancelled
     # Allows each intermediate node to batch responses for up to TTP seconds
     async def get(
             self, label: str, ttl: float, tpf: int, ttp: float,
             group: Optional[str] = None) -> str:
-        log = ContextLogger(self.log, f"get {label}")
+        return (await self.get_many([label], ttl, tpf, ttp, group))[label]
+
+    # Like get(), but returns once every label has a new value
+    async def get_many(
+            self, labels: List[str], ttl: float, tpf: int, ttp: float,
+            group: Optional[str] = None) -> Dict[str, str]:
+        values = {}
+        while len(values) < len(set(labels)):
+            pending = [label for label in labels if label not in values]
+            ready = await self.wait_new(
+                pending, ttl, tpf, ttp, group, asyncio.ALL_COMPLETED)
+            for label, entry in ready.items():
+                data = self.take_new(entry, group)
+                if data is not None:
+                    values[label] = data
+        return values
+
+    # Like get(), but returns the first of labels to have a new value
+    async def wait_any(
+            self, labels: List[str], ttl: float, tpf: int, ttp: float,
+            group: Optional[str] = None) -> Tuple[str, str]:
+        while True:
+            ready = await self.wait_new(
+                labels, ttl, tpf, ttp, group, asyncio.FIRST_COMPLETED)
+            for label, entry in ready.items():
+                data = self.take_new(entry, group)
+                if data is not None:
+                    return label, data
+
+    # Wait until any or all of labels have a value we have not returned yet,
+    # returning those values by label
+    # Interests for every label are (re)sent together with a single batch
+    # reschedule, stopping for each label once it has a new value
+    # New values are returned even if a small content store has since
+    # evicted them to make room for the other labels
+    async def wait_new(
+            self, labels: List[str], ttl: float, tpf: int, ttp: float,
+            group: Optional[str], return_when: str) -> Dict[str, SetItem]:
+        log = ContextLogger(self.log, f"get {','.join(labels)}")
         if self.advert is None:
             raise RuntimeError("Only client nodes can subscribe")
+        loop = asyncio.get_running_loop()
 
-        # Encrypt label
-        if group is not None:
-            # TODO(v0.3): stable label encryption
-            label = group + "//" + label
-            # label = self.groups[group].key.encrypt(label.encode())
-            # label = base64.b64encode(label).decode("ASCII")
-            log.debug("Used group %s key to encrypt label: %s", group, label)
-
-        # Check if local content store already has a new value
-        if label not in self.content_store:
-            self.content_store[label] = SetItem(label, None, 0, [])
-            log.debug("Created new label in local content store")
-        if self.content_store[label].at > self.content_store[label].last:
-            log.info("New value found in local content store")
-        else:
-            log.info("Subscribing for new values...")
+        # Check if local content store already has new values
+        keys = {self.group_label(label, group): label for label in labels}
+        found: Dict[str, SetItem] = {}
+        pending: Dict[str, SetItem] = {}
+        created: List[SetItem] = []
+        for key in keys:
+            entry = self.content_store.get(key)
+            if entry is None:
+                entry = SetItem(key, None, 0, [])
+                log.debug("Created new label %s in local content store", key)
+            entry.last = max(entry.last, self.returned.get(key, 0))
+            if entry.at > entry.last:
+                found[key] = entry
+                continue
 
-            # Many get() calls can be waiting on one pending interests
-            if self.content_store[label].fulfil is None \
-                    or self.content_store[label].fulfil.done() \
-                    or self.content_store[label].fulfil.cancelled():
-                loop = asyncio.get_running_loop()
-                self.content_store[label].fulfil = loop.create_future()
-                log.debug("Created new local interest")
+            # Many get() calls can be waiting on one pending interest
+            if entry.fulfil is None or entry.fulfil.done():
+                entry.fulfil = loop.create_future()
+                created.append(entry)
+                log.debug("Created new local interest in %s", key)
+            pending[key] = entry
+
+        # Only store new entries once every waiting one is pinned, so that
+        # they cannot evict each other from a small content store
+        for key, entry in pending.items():
+            if self.content_store.lookup(key) is None:
+                self.content_store[key] = entry
+
+        if len(found) == 0 or (
+                len(pending) != 0 and return_when == asyncio.ALL_COMPLETED):
+            log.info("Subscribing for new values...")
+            fulfils = {key: entry.fulfil for key, entry in pending.items()}
 
             # Keep trying until either success or this coroutine is cancelled
             async def subscribe():
-                after = self.content_store[label].last
+                afters = {key: entry.last for key, entry in pending.items()}
                 while True:
-                    log.debug("Sending get request...")
-                    self.on_get(log, GetItem(
-                        self.advert.client, label,
-                        after, ttp, time.time() + ttl))
+                    log.debug("Sending get requests...")
+                    for key, fulfil in fulfils.items():
+                        if not fulfil.done():
+                            self.on_get(log, GetItem(
+                                self.advert.client, key, afters[key],
+                                ttp, clock() + ttl, self.new_trace()))
                     if self.is_send_queue_changed:
                         self.schedule_batch_send()
                         self.is_send_queue_changed = False
                     await asyncio.sleep(ttl / tpf)
 
+            # Other get() calls may still be waiting if this one is cancelled
             task = asyncio.create_task(subscribe())
-            assert await self.content_store[label].fulfil
-            task.cancel()
-
-        # Grab new data and decrypt
-        self.content_store[label].last = self.content_store[label].at
-        data = self.content_store[label].data
+            try:
+                await asyncio.wait(
+                    fulfils.values(), return_when=return_when)
+            finally:
+                task.cancel()
+            for key, fulfil in fulfils.items():
+                if fulfil.done():
+                    found[key] = fulfil.result()
+        else:
+            log.info("New value found in local content store")
+            for entry in created:
+                entry.fulfil = None  # Nobody else could be waiting on it
+
+        # Prefer anything even newer which has arrived in the meantime
+        ready = {}
+        for key, entry in found.items():
+            latest = self.content_store.lookup(key)
+            if latest is not None and latest.at > entry.at:
+                entry = latest
+            if entry.at > entry.last:
+                ready[keys[key]] = entry
+        return ready
+
+    # Decrypt a new value, marking it as returned
+    # Which values were returned is also remembered apart from the content
+    # store, which may evict them, so that they are never fetched again
+    def take_new(self, entry: SetItem, group: Optional[str]) -> Optional[str]:
+        entry.last = entry.at
+        self.returned[entry.label] = entry.at
+        data = entry.data
         if group is not None:
             try:
                 data = base64.b64decode(data)
                 data = self.groups[group].key.decrypt(data).decode()
-                log.debug("Decrypted received data with group %s key", group)
+                self.log.debug(
+                    "Decrypted received data with group %s key", group)
             except InvalidToken:
-                log.warning("Unable to decrypt group %s data", group)
-                data = self.get(label, ttl, tpf, ttp, group)
+                self.log.warning("Unable to decrypt group %s data", group)
+                return None
         return data
 
+    # Label as sent on the network for a label of a group
+    def group_label(self, label: str, group: Optional[str]) -> str:
+        if group is None:
+            return label
+        # TODO(v0.3): stable label encryption
+        # label = self.groups[group].key.encrypt(label.encode())
+        # label = base64.b64encode(label).decode("ASCII")
+        return group + "//" + label
+
+    # Subscribes to label, yielding each new value as it arrives
+    # Unlike calling get() in a loop, one interest is kept for as long as the
+    # subscription is open, refreshed every TTL/TPF seconds regardless of
+    # values arriving, which saves re-sending interests after every value
+    # Use with "async with" (or close() it) to stop refreshing the interest
+    def subscribe(
+            self, label: str, ttl: float, tpf: int, ttp: float,
+            group: Optional[str] = None, keep_all: bool = False,
+            buffer: int = SUBSCRIBE_BUFFER) -> Subscription:
+        log = ContextLogger(self.log, f"subscribe {label}")
+        if self.advert is None:
+            raise RuntimeError("Only client nodes can subscribe")
+        label = self.group_label(label, group)
+
+        # Only ask for values newer than the one we already have
+        subscription = Subscription(self, label, group, keep_all, buffer)
+        s = self.content_store.get(label)
+        if s is not None and s.data is not None:
+            subscription.after = s.at
+        self.subscriptions.setdefault(label, []).append(subscription)
+
+        async def refresh():
+            while True:
+                log.debug("Refreshing interest...")
+                self.on_get(log, GetItem(
+                    self.advert.client, label, subscription.after,
+                    ttp, clock() + ttl, self.new_trace()))
+                if self.is_send_queue_changed:
+                    self.schedule_batch_send()
+                    self.is_send_queue_changed = False
+                await asyncio.sleep(ttl / tpf)
+
+        subscription.task = asyncio.create_task(refresh())
+        log.info("Subscribed")
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        if subscription.closed:
+            return
+        subscription.closed = True
+        subscription.task.cancel()
+        subscriptions = self.subscriptions[subscription.label]
+        subscriptions.remove(subscription)
+        if len(subscriptions) == 0:
+            del self.subscriptions[subscription.label]
+        if subscription.waiter is not None \
+                and not subscription.waiter.done():
+            subscription.waiter.set_result(None)
+
     # Publishes a new value to a label
     # This will only be propagated towards interested clients
-    async def set(self, label: str, data: str, group: Optional[str] = None):
-        log = ContextLogger(self.log, f"set {label}")
+    # Nodes will forget the value max_age seconds after publishing if given
+    async def set(
+            self, label: str, data: str, group: Optional[str] = None,
+            max_age: Optional[float] = None):
+        await self.set_many({label: data}, group, max_age)
+
+    # Publishes new values to many labels at once, queueing them all before
+    # rescheduling the next batch only once
+    async def set_many(
+            self, values: Dict[str, str], group: Optional[str] = None,
+            max_age: Optional[float] = None):
         if self.advert is None:
             raise RuntimeError("Only client nodes can publish")
 
-        # Encrypt label and data
-        if group is not None:
-            data = self.groups[group].key.encrypt(data.encode())
-            data = base64.b64encode(data).decode("ASCII")
-            # TODO(v0.3): stable label encryption
-            label = group + "//" + label
-            # label = self.groups[group].key.encrypt(label.encode())
-            # label = base64.b64encode(label).decode("ASCII")
-            log.debug("Used group key to encrypt label and data: %s", label)
-
-        dst = []
-        if label in self.interests:
-            for get_item in self.interests[label].values():
-                dst.append((get_item.ttp, get_item.client))
-
-        self.on_set(log, SetItem(label, data, time.time(), dst))
+        now = clock()
+        for label, data in values.items():
+            log = ContextLogger(self.log, f"set {label}")
+
+            # Encrypt label and data
+            if group is not None:
+                data = self.groups[group].key.encrypt(data.encode())
+                data = base64.b64encode(data).decode("ASCII")
+                label = self.group_label(label, group)
+                log.debug(
+                    "Used group key to encrypt label and data: %s", label)
+
+            dst = []
+            if label in self.interests:
+                for get_item in self.interests[label].values():
+                    dst.append((get_item.ttp, get_item.client))
+
+            self.on_set(log, SetItem(
+                label, data, now, dst, max_age, self.new_trace()))
         if self.is_send_queue_changed:
             self.schedule_batch_send()
             self.is_send_queue_changed = False
 
+    # Start tracing one in every trace_every of our gets and sets
+    def new_trace(self) -> Optional[Trace]:
+        if self.trace_every is None \
+                or next(self.trace_seq) % self.trace_every != 0:
+            return None
+        return Trace(os.urandom(8).hex(), [Trace.Hop(self.id, clock())])
+
+    # A traced item reached us, its final destination
+    # Kept for the debug port's /traces, override to send them elsewhere
+    def on_trace(self, label: str, item: MessageItem):
+        hops = item.trace.breakdown()
+        total = hops[-1]["arrived"] - hops[0]["arrived"]
+        self.traces.append({
+            "id": item.trace.id,
+            "type": type(item).__name__,
+            "label": label,
+            "total": total,
+            "hops": hops,
+        })
+        self.log.info(
+            "Trace %s of %s %s took %.3fs over %s hops",
+            item.trace.id, type(item).__name__, label, total, len(hops) - 1)
+
     # Group encryption and authorisation
     async def join(
             self, group: str, client: str, key: bytes,
@@ -556,7 +2318,7 @@ class Node:
                 if inner["at"] == 0 and self.groups[group].at == 0:
                     log.info("Generated new group key")
                     self.groups[group].raw = Fernet.generate_key()
-                    self.groups[group].at = time.time()
+                    self.groups[group].at = clock()
                     break
 
                 # Ignore if we have a newer group key, they need to receive
@@ -609,7 +2371,123 @@ class Node:
         task = asyncio.create_task(handle_invites())
         self.groups[group].tasks[client] = task
 
+    # Start timing calls to the TIMED_HANDLERS in the tcdicn_handler_seconds
+    # metric, or stop it again
+    # Timed wrappers shadow the methods on this instance while enabled, so
+    # that nothing at all is measured or checked otherwise
+    def set_handler_timing(self, enabled: bool):
+        self.is_timing_handlers = enabled
+        for name in TIMED_HANDLERS:
+            self.__dict__.pop(name, None)
+            if enabled:
+                setattr(self, name, self.timed(name, getattr(self, name)))
+        self.log.info("Handler timing %s", "on" if enabled else "off")
+
+    def timed(self, name: str, handler):
+        labels = (("handler", name),)
+
+        if asyncio.iscoroutinefunction(handler):
+            async def timed_coroutine(*args):
+                start = time.perf_counter()
+                try:
+                    return await handler(*args)
+                finally:
+                    self.metrics.observe(
+                        "tcdicn_handler_seconds",
+                        time.perf_counter() - start, labels)
+            return timed_coroutine
+
+        def timed_function(*args):
+            start = time.perf_counter()
+            try:
+                return handler(*args)
+            finally:
+                self.metrics.observe(
+                    "tcdicn_handler_seconds",
+                    time.perf_counter() - start, labels)
+        return timed_function
+
+    # Measure event loop lag until cancelled, reporting what was running
+    # whenever the loop is blocked for longer than threshold seconds
+    # A watchdog thread notices the loop's heartbeat stopping and captures the
+    # loop thread's stack then, which is reported once the loop is free again
+    # Code holding the GIL throughout is only caught just after it returns
+    async def watch_loop(self, threshold: float = STALL_THRESHOLD):
+        loop = asyncio.get_running_loop()
+        interval = threshold / STALL_CHECKS
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self.watchdog,
+            args=(loop, threading.get_ident(), threshold, interval, stop),
+            daemon=True)
+        self.heartbeat = time.monotonic()
+        thread.start()
+        self.log.info("Watching for event loop stalls over %ss", threshold)
+        try:
+            while True:
+                start = loop.time()
+                await asyncio.sleep(interval)
+                self.heartbeat = time.monotonic()
+                self.metrics.observe(
+                    "tcdicn_loop_lag_seconds",
+                    max(0, loop.time() - start - interval))
+        finally:
+            stop.set()
+
+    # Runs in the watchdog thread, so only hands stacks over to the loop
+    def watchdog(
+            self, loop: asyncio.AbstractEventLoop, thread_id: int,
+            threshold: float, interval: float, stop: threading.Event):
+        reported = None
+        while not stop.wait(interval):
+            heartbeat = self.heartbeat
+            late = time.monotonic() - heartbeat - interval
+            if heartbeat == reported or late < threshold:
+                continue
+            reported = heartbeat
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                return
+            stack = traceback.extract_stack(frame)
+            try:
+                loop.call_soon_threadsafe(
+                    self.on_stall, heartbeat + interval, stack)
+            except RuntimeError:
+                return  # Loop closed
+
+    def on_stall(self, since: float, stack: traceback.StackSummary):
+
+        # Attribute the stall to the innermost call in this module, or else
+        # in whatever is running the loop, ignoring asyncio's own frames
+        internal = os.path.dirname(asyncio.__file__)
+        site = stack[-1]
+        for frame in reversed(stack):
+            if frame.filename == __file__:
+                site = frame
+                break
+        else:
+            for frame in reversed(stack):
+                if not frame.filename.startswith(internal):
+                    site = frame
+                    break
+        name = f"{site.name} ({os.path.basename(site.filename)}:{site.lineno})"
+
+        # Only log what the loop was running, not the loop itself
+        start = 0
+        for i, frame in enumerate(stack):
+            if frame.filename.startswith(internal):
+                start = i + 1
+        stack = stack[start:] if start < len(stack) else stack
+
+        self.metrics.inc("tcdicn_loop_stalls_total", (("site", name),))
+        self.log.warning(
+            "Event loop blocked for %.3fs in %s:\n%s",
+            time.monotonic() - since, name,
+            "".join(traceback.format_list(stack)).rstrip())
+
     # Start a web server for visualising the state of this node
+    # Besides the node's state, it serves /metrics, /timing, /profile and
+    # /traces
     async def serve_debug(self, port: int):
         server = await asyncio.start_server(
             self.on_debug_connection, "0.0.0.0", port)
@@ -619,6 +2497,56 @@ class Node:
 
     # Batching
 
+    # Queue an item to be sent towards client before its deadline
+    # Items are grouped by their next hop: the best route to the client, or
+    # the device's main node if we are not it (or None if there is no route)
+    # Routes via peers whose circuit breaker is not closed are skipped
+    # A pending older value of the same label for the same client is dropped
+    # even if it was queued towards a different next hop
+    def queue_send(
+            self, deadline: float, client: Optional[str],
+            routes: List[Addr], item: MessageItem):
+        if not self.is_main:
+            addr = ("127.0.0.1", self.dport)
+        else:
+            healthy = [r for r in routes if self.is_healthy(r)]
+            if len(healthy) == 0 and len(routes) != 0:
+                # Hold the item until the first of its skipped peers is probed
+                deadline = max(deadline, self.next_probe(routes))
+            else:
+                routes = healthy
+            addr = healthy[0] if len(healthy) != 0 else None
+        if getattr(item, "trace", None) is not None:
+            # The same item can be queued towards many next hops
+            item = copy.copy(item)
+            item.trace = item.trace.fork()
+            if item.trace.hops[-1].queued is None:
+                item.trace.hops[-1].queued = clock()
+        if addr not in self.send_queues:
+            self.send_queues[addr] = SendQueue()
+        send_queue = self.send_queues[addr]
+        entry = (deadline, next(self.send_seq), client, routes, item)
+        if type(item) is SetItem:
+            key = SendQueue.key(entry)
+            prev = self.send_index.get(key, addr)
+            if prev != addr and prev in self.send_queues:
+                old = self.send_queues[prev].take(key)
+                if old is not None:
+                    send_queue.push(old)
+            self.send_index[key] = addr
+        if send_queue.push(entry):
+            self.send_coalesced += 1
+        self.is_send_queue_changed = True
+
+    # Remove entries which have just left a send queue from the set index
+    def unindex_sends(
+            self, addr: Optional[Addr], entries: List[SendQueue.Entry]):
+        for entry in entries:
+            if type(entry[4]) is SetItem:
+                key = SendQueue.key(entry)
+                if self.send_index.get(key, addr) == addr:
+                    self.send_index.pop(key, None)
+
     def schedule_batch_send(self):
 
         # Check for previous scheduled batch
@@ -627,14 +2555,14 @@ class Node:
             self.batch_send_task = None
 
         # Find next item deadline
-        try:
-            deadline, client, routes, item = self.send_queue.get_nowait()
-            self.send_queue.put_nowait((deadline, client, routes, item))
-        except queue.Empty:
+        deadline = min(
+            (q.deadline() for q in self.send_queues.values() if len(q) != 0),
+            default=None)
+        if deadline is None:
             return
 
         # Schedule new time
-        now = time.time()
+        now = clock()
         eol = (deadline - now) / 2 + now
         task = do_after(eol, lambda: asyncio.create_task(self.batch_send()))
         self.batch_send_task = task
@@ -642,60 +2570,195 @@ class Node:
 
     async def batch_send(self):
         log = ContextLogger(self.log, "tcp batch")
-
-        accepted = []
-        rejects = []
-        addr = None
-
-        # Include all items in queue destined to the next peer
-        while True:
-            try:
-                deadline, client, routes, item = self.send_queue.get_nowait()
-            except queue.Empty:
-                break
-
-            try:
-                peer = routes[0]["addr"] if self.is_main \
-                    else ("127.0.0.1", self.dport)  # Non-main push to main
-            except IndexError:
-                if client in self.routes:
-                    routes = self.routes[client]
-                rejects.append((deadline + DEADLINE_EXT, client, routes, item))
-                log.warning("No route to %s", client)
-                continue
-
-            if addr is None:
-                addr = peer
-                log.debug("Batch destined to %s", addr)
-
-            if peer == addr:
-                accepted.append((deadline, client, routes, item))
-                log.debug("Added %s", type(item).__name__)
-            else:
-                rejects.append((deadline, client, routes, item))
-                log.debug("Rejected %s", type(item).__name__)
-
-        # Put everything else back
-        for reject in rejects:
-            self.send_queue.put_nowait(reject)
-        items = [item for _, _, _, item in accepted]
-
-        # Send it!
-        if addr is not None:
-            try:
-                await self.send_msg(addr, Message(items))
-            except (asyncio.TimeoutError, OSError):
-                log.warning("Unable to contact %s", addr)
-                ext = 0 if self.is_main else DEADLINE_EXT
-                for deadline, client, routes, item in accepted:
-                    self.send_queue.put_nowait(
-                        (deadline + ext, client, routes[1:], item))
-        else:
+        now = clock()
+
+        # Also flush items we would otherwise need to wake up for again
+        # before the earliest deadline that triggered this batch
+        deadline = min(
+            (q.deadline() for q in self.send_queues.values() if len(q) != 0),
+            default=None)
+        if deadline is None:
             log.warning("There was nothing to send")
+            return
+        horizon = max(2 * deadline - now, now)  # Overdue items go right away
+
+        # Try to find routes for due items which had none
+        if None in self.send_queues:
+            entries = self.send_queues.pop(None).pop_all()
+            self.unindex_sends(None, entries)
+            for entry in entries:
+                deadline, _, client, routes, item = entry
+                if deadline > horizon or len(routes) != 0:
+                    self.queue_send(deadline, client, routes, item)
+                else:
+                    # Every route has failed, so back off before retrying
+                    routes = self.routes.get(client)
+                    if len(routes) == 0:
+                        log.warning("No route to %s", client)
+                    self.queue_send(
+                        max(deadline, now) + DEADLINE_EXT,
+                        client, routes, item)
+
+        # Send everything queued towards each due peer concurrently
+        batches = []
+        for addr, send_queue in list(self.send_queues.items()):
+            if len(send_queue) == 0:
+                del self.send_queues[addr]
+            elif addr is not None and send_queue.deadline() <= horizon:
+                del self.send_queues[addr]
+                batches.append(self.batch_send_to(log, addr, send_queue))
+        await asyncio.gather(*batches)
 
         # Schedule next batch
         self.schedule_batch_send()
 
+    # Items which would miss their deadline if the next hop does not answer
+    # may race it against their next best route (see RACE_STAGGER)
+    async def batch_send_to(
+            self, log: Logger, addr: Addr, send_queue: SendQueue):
+        entries = send_queue.pop_all()
+        self.unindex_sends(addr, entries)
+        log.debug("Batch of %s items destined to %s", len(entries), addr)
+
+        groups: Dict[Optional[Addr], List[SendQueue.Entry]] = {}
+        now = clock()
+        labels = (("transport", "tcp"),)
+        for entry in entries:
+            deadline, _, _, routes, _ = entry
+            self.metrics.observe(
+                "tcdicn_batch_slack_seconds", deadline - now, labels)
+            backup = None
+            if self.race_stagger is not None and self.is_main \
+                    and len(routes) > 1 and deadline - now < TCP_TIMEOUT:
+                backup = routes[1]
+            groups.setdefault(backup, []).append(entry)
+        await asyncio.gather(*(
+            self.batch_race(log, addr, backup, group)
+            for backup, group in groups.items()))
+
+    async def batch_race(
+            self, log: Logger, addr: Addr, backup: Optional[Addr],
+            entries: List[SendQueue.Entry]):
+        items = [item for _, _, _, _, item in entries]
+        race = Race()
+        tried = 1
+        self.metrics.observe(
+            "tcdicn_batch_items", len(items), (("transport", "tcp"),))
+
+        # Send it, starting the backup if the first choice is slow or fails
+        sent = False
+        pending = {asyncio.create_task(self.try_send(log, addr, items, race))}
+        if backup is not None:
+            done, pending = await asyncio.wait(
+                pending, timeout=self.race_stagger)
+            sent = any(task.result() for task in done)
+            if not sent:
+                log.debug("Racing %s items via %s", len(items), backup)
+                self.races += 1
+                tried = 2
+                pending.add(asyncio.create_task(
+                    self.try_send(log, backup, items, race)))
+        while not sent and len(pending) != 0:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            sent = any(task.result() for task in done)
+        for task in pending:
+            task.cancel()  # Still connecting, so never claimed the race
+        if sent:
+            if race.winner == backup:
+                self.races_won += 1
+            return
+
+        # Retry along the remaining routes in a later batch
+        ext = 0 if self.is_main else DEADLINE_EXT
+        failed = [f"{a[0]}:{a[1]}" for a in [addr, backup][:tried]]
+        for deadline, _, client, routes, item in entries:
+            if getattr(item, "trace", None) is not None:
+                item.trace.hops[-1].failed += failed
+            self.queue_send(deadline + ext, client, routes[tried:], item)
+
+    # Returns True if the items were sent to addr, or False if that failed or
+    # another attempt won the race to deliver them
+    async def try_send(
+            self, log: Logger, addr: Addr, items: List[MessageItem],
+            race: Race) -> bool:
+        if addr not in self.costs:
+            self.costs[addr] = PeerCost()
+        cost = self.costs[addr]
+        start = clock()
+        for item in items:
+            if getattr(item, "trace", None) is not None:
+                item.trace.hops[-1].sent = start
+                item.trace.hops[-1].next = f"{addr[0]}:{addr[1]}"
+        try:
+            sent = await self.send_msg(addr, Message(items), race)
+        except (asyncio.TimeoutError, OSError):
+            cost.sample(clock() - start, True, len(items))
+            log.warning("Unable to contact %s", addr)
+            self.metrics.inc("tcdicn_connection_failures_total")
+            self.on_send_failure(addr)
+            return False
+        if sent:
+            cost.sample(clock() - start, False, len(items))
+            self.on_send_success(addr)
+        return sent
+
+    # Circuit breaking
+
+    def is_healthy(self, addr: Addr) -> bool:
+        breaker = self.breakers.get(addr)
+        return breaker is None or breaker.is_closed()
+
+    # Earliest time any of the given skipped peers might be healthy again
+    def next_probe(self, addrs: List[Addr]) -> float:
+        now = clock()
+        probes = []
+        for addr in addrs:
+            breaker = self.breakers.get(addr)
+            if breaker is None or breaker.is_closed():
+                return now
+            if breaker.state == Breaker.OPEN and breaker.probe_at > now:
+                probes.append(breaker.probe_at)
+            else:
+                probes.append(now + TCP_TIMEOUT)  # Probe is under way
+        return min(probes, default=now)
+
+    def on_send_success(self, addr: Addr):
+        breaker = self.breakers.get(addr)
+        if breaker is not None and not breaker.is_closed():
+            self.log.info("Peer %s is reachable again", addr)
+        if breaker is not None:
+            breaker.success()
+
+    def on_send_failure(self, addr: Addr):
+        if addr not in self.breakers:
+            self.breakers[addr] = Breaker()
+        breaker = self.breakers[addr]
+        if breaker.failure():
+            self.log.warning(
+                "Skipping peer %s for %ss after %s failures",
+                addr, breaker.reset, breaker.failures)
+            breaker.probe_at = clock() + breaker.reset
+            breaker.timer = self.timers.add(
+                breaker.probe_at,
+                lambda: asyncio.create_task(self.probe(addr, breaker)),
+                breaker.timer)
+
+    # Check in the background whether a skipped peer accepts messages again
+    # by sending it an empty one, which any version of node quietly accepts
+    async def probe(self, addr: Addr, breaker: Breaker):
+        if self.breakers.get(addr) is not breaker:
+            return  # Peer has since timed out
+        breaker.state = Breaker.HALF_OPEN
+        self.log.debug("Probing peer %s", addr)
+        try:
+            await self.send_msg(addr, Message([]))
+        except (asyncio.TimeoutError, OSError):
+            self.metrics.inc("tcdicn_connection_failures_total")
+            self.on_send_failure(addr)
+            return
+        self.on_send_success(addr)
+
     def schedule_batch_broadcast(self):
 
         # Check for previous scheduled batch
@@ -704,14 +2767,12 @@ class Node:
             self.batch_broadcast_task = None
 
         # Find next item deadline
-        try:
-            deadline, item = self.broadcast_queue.get_nowait()
-            self.broadcast_queue.put_nowait((deadline, item))
-        except queue.Empty:
+        deadline = self.broadcast_queue.deadline()
+        if deadline is None:
             return
 
         # Schedule new time
-        now = time.time()
+        now = clock()
         eol = (deadline - now) / 2 + now
         task = do_after(eol, self.batch_broadcast)
         self.batch_broadcast_task = task
@@ -719,93 +2780,286 @@ class Node:
 
     def batch_broadcast(self):
         log = ContextLogger(self.log, "udp batch")
+        now = clock()
+        horizon = None
 
-        items = []
-        msg = Message([])
-        msg_bytes = msg.to_bytes()
-        msg_len = len(msg_bytes)
+        # Use the binary encoding if every peer that can hear us supports it
+        binary = len(self.peers) != 0 and all(
+            peer.features & FEATURE_BINARY for peer in self.peers.values())
+        sep = 0 if binary else 1
+
+        def to_part(item: MessageItem) -> bytes:
+            return item.to_binary() if binary else encode(item.to_dict())
 
-        # Add as many pending items to this broadcast as we safely can
-        # Force at least one if this is any to prevent queue blocking
+        # Always carry our identity so that we can ignore our own broadcasts
+        base = [] if self.peer is None else [to_part(self.peer)]
+        base_len = len(Message.join(base, binary))
+
+        # Encode each pending item once, packing them into as few datagrams
+        # as possible while tracking the size of the current one as we go
+        batches = []
+        parts, size = list(base), base_len
         while True:
-            try:
-                deadline, item = self.broadcast_queue.get_nowait()
-            except queue.Empty:
+            entry = self.broadcast_queue.pop()
+            if entry is None:
                 break
+            deadline, item = entry
+
+            # Also flush items we would otherwise need to wake up for again
+            # before the deadline of the item that triggered this batch
+            if horizon is None:
+                horizon = max(2 * deadline - now, now)
 
-            # TODO(optimisation): score based on perceived congestion
-            # for now, use some randomness to diversify routes taken
-            import random
+            # Re-advertise our own best score after the cost of its path,
+            # using a copy as the queued advert is shared with self.clients
+            sent = item
             if type(item) is AdvertItem:
-                item.score -= 1 + random.uniform(0, 0.5)
-
-            new_items = items + [item]
-            new_msg = Message(new_items)
-            new_msg_bytes = new_msg.to_bytes()
-            new_msg_len = len(new_msg_bytes)
-            diff = new_msg_len - msg_len
-            if len(items) != 0 and new_msg_len >= BROADCAST_CAPACITY:
-                log.debug("Refused %s (+%s bytes)", type(item).__name__, diff)
-                self.broadcast_queue.put_nowait((deadline, item))
-                break
-            log.debug("Added %s (+%s bytes)", type(item).__name__, diff)
+                sent = copy.copy(item)
+                sent.score = self.advertised_score(item)
 
-            items = new_items
-            msg = new_msg
-            msg_len = new_msg_len
+            part = to_part(sent)
+            diff = len(part) + (sep if len(parts) != 0 else 0)
+
+            # Start a new datagram if full, but force at least one item in
+            if len(parts) > len(base) and size + diff >= BROADCAST_CAPACITY:
+                if deadline > horizon:
+                    log.debug("Deferred %s", type(item).__name__)
+                    self.broadcast_queue.push(deadline, item)
+                    break
+                batches.append(
+                    (len(parts) - len(base), Message.join(parts, binary)))
+                parts, size = list(base), base_len
+                diff = len(part) + (sep if len(parts) != 0 else 0)
+
+            parts.append(part)
+            size += diff
+            self.broadcast_queue.mark_sent(item.client, now)
+            self.metrics.observe(
+                "tcdicn_batch_slack_seconds", deadline - now,
+                (("transport", "udp"),))
+            log.debug("Added %s (+%s bytes)", type(item).__name__, diff)
+        if len(parts) > len(base):
+            batches.append(
+                (len(parts) - len(base), Message.join(parts, binary)))
 
         # Send it!
-        try:
-            self.broadcast_msg(msg)
-        except OSError as e:
-            log.warning("Error broadcasting batch: %s", e)
+        labels = (("transport", "udp"),)
+        for count, data in batches:
+            try:
+                self.broadcast_bytes(data, count)
+            except OSError as e:
+                log.warning("Error broadcasting batch: %s", e)
+                continue
+            self.metrics.observe("tcdicn_batch_items", count, labels)
+            self.metrics.inc(
+                "tcdicn_items_sent_total",
+                (("type", "AdvertItem"),) + labels, count)
+            if len(base) != 0:
+                self.metrics.inc(
+                    "tcdicn_items_sent_total",
+                    (("type", "PeerItem"),) + labels)
+        if len(batches) == 0:
+            log.warning("There was nothing to broadcast")
 
         # Schedule next batch
         self.schedule_batch_broadcast()
 
     # Network methods - May raise OSError
 
-    async def send_msg(self, addr: Addr, msg: Message):
-        msg_bytes = msg.to_bytes()
-        connection = asyncio.open_connection(addr[0], addr[1])
-        _, writer = await asyncio.wait_for(connection, timeout=TCP_TIMEOUT)
-        writer.write(msg_bytes)
-        await writer.drain()
-        writer.close()
+    # Returns False without sending anything if the message lost the race
+    async def send_msg(
+            self, addr: Addr, msg: Message,
+            race: Optional[Race] = None) -> bool:
+        peer = self.peers.get(addr)
+        features = 0 if peer is None else peer.features
+        if any(getattr(i, "trace", None) is not None for i in msg.items):
+            features &= ~FEATURE_BINARY  # Only JSON carries traces
+        msg_bytes = msg.to_bytes(features & FEATURE_BINARY != 0)
+        if features & FEATURE_STREAM:
+            if not await self.send_stream(addr, msg_bytes, race):
+                return False
+        else:
+            _, writer = await self.network.connect(addr, TCP_TIMEOUT)
+            if race is not None and not race.claim(addr):
+                writer.close()
+                return False
+            writer.write(msg_bytes)
+            await writer.drain()
+            writer.close()
+        labels = (("transport", "tcp"),)
+        self.metrics.inc("tcdicn_messages_sent_total", labels)
+        self.metrics.inc("tcdicn_bytes_sent_total", labels, len(msg_bytes))
+        self.count_items("tcdicn_items_sent_total", "tcp", msg.items)
         self.log.debug(
-            "Sent %s items: %s (%s bytes)",
-            addr, len(msg.items), len(msg_bytes))
+            "Sent %s items to %s (%s bytes)",
+            len(msg.items), addr, len(msg_bytes))
+        return True
+
+    # Send a length prefixed message over our persistent connection to addr,
+    # waiting for the peer to acknowledge it
+    # A pooled connection which turns out to be closed is replaced once, but
+    # a peer which does not acknowledge the message in time has failed
+    async def send_stream(
+            self, addr: Addr, data: bytes,
+            race: Optional[Race] = None) -> bool:
+        if len(data) > MAX_FRAME:
+            raise OSError(f"Message too large to send ({len(data)} bytes)")
+        frame = struct.pack("!I", len(data)) + data
+        while True:
+            connection = self.connections.get(addr)
+            is_pooled = connection is not None and connection.is_open()
+            if not is_pooled:
+                connection = await self.connect(addr)
+            if race is not None and not race.claim(addr):
+                is_sent = False
+                break
+            ack = asyncio.get_running_loop().create_future()
+            try:
+                async with connection.lock:
+                    connection.acks.append(ack)
+                    connection.writer.write(frame)
+                    await asyncio.wait_for(
+                        connection.writer.drain(), timeout=DATA_TIMEOUT)
+                await asyncio.wait_for(ack, timeout=DATA_TIMEOUT)
+            except asyncio.CancelledError:
+                ack.cancel()  # Abandoned, eg by losing a race
+                raise
+            except (asyncio.TimeoutError, OSError):
+                is_unanswered = ack.cancelled()  # Timed out waiting for it
+                ack.cancel()
+                self.disconnect(addr, connection)
+                if is_pooled and not is_unanswered:
+                    continue
+                raise
+            is_sent = True
+            break
+
+        # Close the connection after it has been idle for a while
+        connection.timer = self.timers.add(
+            clock() + CONNECTION_IDLE,
+            lambda: self.disconnect(addr, connection), connection.timer)
+        return is_sent
+
+    # Open a new persistent connection to addr, replacing any previous one
+    async def connect(self, addr: Addr) -> Connection:
+        reader, writer = await self.network.connect(addr, TCP_TIMEOUT)
+        if addr in self.connections:
+            self.disconnect(addr, self.connections[addr])
+        connection = Connection(reader, writer)
+        connection.task = asyncio.create_task(
+            self.read_acks(addr, connection))
+        self.connections[addr] = connection
+        self.log.debug("Opened connection to %s", addr)
+        return connection
+
+    # Resolve the acknowledgements of sent messages in order until closed
+    async def read_acks(self, addr: Addr, connection: Connection):
+        try:
+            while True:
+                if await connection.reader.readexactly(1) != STREAM_ACK \
+                        or len(connection.acks) == 0:
+                    self.log.warning("Unexpected reply from %s", addr)
+                    break
+                ack = connection.acks.popleft()
+                if not ack.done():
+                    ack.set_result(None)
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        finally:
+            self.disconnect(addr, connection)
+
+    def disconnect(self, addr: Addr, connection: Connection):
+        if self.connections.get(addr) is connection:
+            del self.connections[addr]
+            self.log.debug("Closed connection to %s", addr)
+        if connection.timer is not None:
+            self.timers.cancel(connection.timer)
+        if connection.task is not None \
+                and connection.task is not asyncio.current_task():
+            connection.task.cancel()
+        while len(connection.acks) != 0:
+            ack = connection.acks.popleft()
+            if not ack.done():
+                ack.set_exception(ConnectionResetError("Connection closed"))
+        connection.writer.close()
+
+    # Keep the multicast group joined on exactly the interfaces we announce on
+    def join_multicast(self):
+        if self.discovery == "broadcast":
+            return
+        sock = self.udp.get_extra_info("socket")
+        group = socket.inet_aton(self.multicast_group)
+        wanted = {
+            i.addr for i in self.interfaces
+            if self.multicast_interfaces is None
+            or i.name in self.multicast_interfaces}
+        for addr in self.multicast_joined - wanted:
+            self.multicast_joined.discard(addr)
+            try:
+                sock.setsockopt(
+                    socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP,
+                    group + socket.inet_aton(addr))
+            except OSError:
+                pass  # Interface already gone
+            self.log.info("Left %s on %s", self.multicast_group, addr)
+        for addr in wanted - self.multicast_joined:
+            try:
+                sock.setsockopt(
+                    socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                    group + socket.inet_aton(addr))
+            except OSError as e:
+                self.log.warning(
+                    "Unable to join %s on %s: %s",
+                    self.multicast_group, addr, e)
+                continue
+            self.multicast_joined.add(addr)
+            self.log.info("Joined %s on %s", self.multicast_group, addr)
+
+    # Cost of routing via peer, as a score penalty
+    def route_cost(self, addr: Addr) -> float:
+        cost = self.costs.get(addr)
+        return 1 if cost is None else cost.cost()
+
+    # Score to re-advertise for a client: our best route after its path cost
+    def advertised_score(self, advert: AdvertItem) -> float:
+        if len(self.routes.get(advert.client)) != 0:
+            return self.routes[advert.client].best()[1]
+        return advert.score - 1
 
-    # TODO(optimisation): use multicast instead of broadcast
     def broadcast_msg(self, msg: Message):
-        msg_bytes = msg.to_bytes()
-        host = socket.gethostname()
-        addrs = socket.getaddrinfo(
-            host, self.dport, family=socket.AF_INET, proto=socket.IPPROTO_UDP)
-        for (_, _, _, _, (host, port)) in addrs:
-            net = ipaddress.IPv4Network(host + "/24", False)  # NOTE: hardcoded
-            self.udp.sendto(msg_bytes, (str(net.broadcast_address), port))
-        self.log.debug(
-            "Broadcasted items: %s (%s bytes)",
-            len(msg.items), len(msg_bytes))
+        self.broadcast_bytes(msg.to_bytes(), len(msg.items))
+        self.count_items("tcdicn_items_sent_total", "udp", msg.items)
+
+    def broadcast_bytes(self, data: bytes, count: int):
+        if self.discovery != "multicast":
+            for interface in self.interfaces:
+                self.udp.sendto(data, (interface.broadcast, self.dport))
+        if self.discovery != "broadcast":
+            # Datagrams are sent straight away unless the socket is backed up,
+            # so selecting the outgoing interface per send is good enough
+            sock = self.udp.get_extra_info("socket")
+            for addr in self.multicast_joined:
+                sock.setsockopt(
+                    socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                    socket.inet_aton(addr))
+                self.udp.sendto(data, (self.multicast_group, self.dport))
+        labels = (("transport", "udp"),)
+        self.metrics.inc("tcdicn_messages_sent_total", labels)
+        self.metrics.inc("tcdicn_bytes_sent_total", labels, len(data))
+        self.log.debug("Broadcasted items: %s (%s bytes)", count, len(data))
+
+    def count_items(
+            self, name: str, transport: str, items: List[MessageItem]):
+        for item in items:
+            self.metrics.inc(
+                name, (("type", type(item).__name__), ("transport", transport)))
 
     # Network event handlers
 
     # UDP datagram entry point
     def on_datagram(self, data: bytes, addr: Addr):
         log = ContextLogger(self.log, f"UDP {addr[0]}:{addr[1]}")
-
-        # Ignore own broadcasts
-        l_addrs = socket.getaddrinfo(socket.gethostname(), self.port)
-        r_addrs = socket.getaddrinfo(socket.getfqdn(addr[0]), addr[1])
-        for (_, _, _, _, l_addr) in l_addrs:
-            for (_, _, _, _, r_addr) in r_addrs:
-                if r_addr == l_addr:
-                    log.debug("Ignored broadcast from self")
-                    return
-
-        # Handle message
-        self.on_message(log, addr, data)
+        self.on_message(log, addr, data, "udp")
 
     # TCP connection entry point
     async def on_connection(self, reader: StreamReader, writer: StreamWriter):
@@ -813,27 +3067,116 @@ class Node:
         log = ContextLogger(self.log, f"TCP {addr[0]}:{addr[1]}")
         log.debug("New connection")
 
-        # Read entire message
         try:
-            data = await asyncio.wait_for(reader.read(), timeout=DATA_TIMEOUT)
+            # Older peers send one JSON message per connection and then close
+            data = await asyncio.wait_for(
+                reader.read(1), timeout=DATA_TIMEOUT)
+            if data != b"\x00":
+                data += await asyncio.wait_for(
+                    reader.read(), timeout=DATA_TIMEOUT)
+                self.on_message(log, addr, data, "tcp")
+                return
+
+            # Otherwise read length prefixed messages until closed or idle
+            self.streams.append(writer)
+            while True:
+                data += await asyncio.wait_for(
+                    reader.readexactly(3), timeout=DATA_TIMEOUT)
+                length = struct.unpack("!I", data)[0]
+                data = await asyncio.wait_for(
+                    reader.readexactly(length), timeout=DATA_TIMEOUT)
+                writer.write(STREAM_ACK)
+                self.on_message(log, addr, data, "tcp")
+                data = await asyncio.wait_for(
+                    reader.readexactly(1), timeout=2 * CONNECTION_IDLE)
+                if data != b"\x00":
+                    log.warning("Closing stream with oversized message")
+                    return
+        except asyncio.IncompleteReadError as exc:
+            if len(exc.partial) != 0:
+                log.warning("Connection closed mid message")
         except asyncio.TimeoutError:
             log.warning("Read timed out")
-            return
         except Exception as exc:
             log.warning("Error reading: %s", exc)
-            return
         finally:
+            if writer in self.streams:
+                self.streams.remove(writer)
             writer.close()
 
-        # Handle message
-        self.on_message(log, addr, data)
-
     # Debug web server TCP connection entry point
     async def on_debug_connection(self, reader: StreamReader, writer: StreamWriter):
         addr = writer.get_extra_info("peername")[0:2]
         log = ContextLogger(self.log, f"TCP {addr[0]}:{addr[1]}")
         log.info("New debug connection")
 
+        # Read the request, serving the plain text dump to unknown paths
+        path = "/"
+        try:
+            line = await asyncio.wait_for(
+                reader.readline(), timeout=DATA_TIMEOUT)
+            if len(line.split(b" ")) > 1:
+                path = line.split(b" ")[1].decode(errors="replace")
+            while line not in (b"", b"\r\n", b"\n"):
+                line = await asyncio.wait_for(
+                    reader.readline(), timeout=DATA_TIMEOUT)
+        except (asyncio.TimeoutError, OSError):
+            pass
+        url = urllib.parse.urlsplit(path)
+        query = urllib.parse.parse_qs(url.query)
+
+        def respond(status: str, body: str, kind: str = "text/plain"):
+            data = body.encode()
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {kind}\r\n"
+                f"Content-Length: {len(data)}\r\n\r\n".encode() + data)
+            writer.close()
+
+        # Prometheus scrapes
+        if url.path == "/metrics":
+            respond(
+                "200 OK", self.render_metrics(),
+                "text/plain; version=0.0.4")
+            return
+
+        # Handler timing, eg /timing?enable=1 (see TIMED_HANDLERS)
+        if url.path == "/timing":
+            if "enable" in query:
+                self.set_handler_timing(query["enable"][0] not in ("0", ""))
+            state = "enabled" if self.is_timing_handlers else "disabled"
+            respond("200 OK", f"Handler timing {state}\n")
+            return
+
+        # Breakdowns of the latest traced items delivered to us, as JSON lines
+        if url.path == "/traces":
+            respond("200 OK", "".join(
+                json.dumps(t) + "\n" for t in self.traces),
+                "application/jsonl")
+            return
+
+        # Sampling profiler, eg /profile?seconds=10
+        if url.path == "/profile":
+            try:
+                seconds = float(query.get("seconds", ["10"])[0])
+            except ValueError:
+                respond("400 Bad Request", "Invalid seconds\n")
+                return
+            if not 0 < seconds <= PROFILE_MAX_SECONDS:
+                respond(
+                    "400 Bad Request",
+                    f"Seconds must be in (0, {PROFILE_MAX_SECONDS}]\n")
+                return
+            if self.sampler is not None:
+                respond("409 Conflict", "Already profiling\n")
+                return
+            log.info("Profiling for %ss", seconds)
+            self.sampler = Sampler()
+            try:
+                respond("200 OK", await self.sampler.run(seconds))
+            finally:
+                self.sampler = None
+            return
+
         writer.write(b"HTTP/1.1 200 OK\r\n\r\n")
         writer.write(b"Node information\r\n")
         writer.write((f"Listening port: {self.port}\r\n").encode())
@@ -841,25 +3184,97 @@ class Node:
         if self.advert is not None:
             writer.write((f"- Client name: {self.advert.client}\r\n").encode())
             writer.write((f"- Published labels: {self.advert.labels}\r\n").encode())
-            writer.write((f"- Groups: {self.groups.key()}\r\n").encode())
+            writer.write((f"- Groups: {list(self.groups.keys())}\r\n").encode())
         writer.write(b"Known peers:\r\n")
         for peer, info in self.peers.items():
-            writer.write((f"- {peer}: expires {to_human(info.eol)}\r\n").encode())
+            cost = self.costs.get(peer, PeerCost())
+            breaker = self.breakers.get(peer, Breaker())
+            writer.write((f"- {peer}: {breaker}, {cost}, expires {to_human(info.eol)}\r\n").encode())
         writer.write(b"Known clients:\r\n")
         for client, info in self.clients.items():
             writer.write((f"- {client}: publishes={info.labels}, my_score={info.score}, expires {to_human(info.eol)}\r\n").encode())
         writer.write(b"Known routes:\r\n")
         for client, info in self.routes.items():
             if len(info) > 0:
-                writer.write((f"- {client}: peer={info[0]['addr']} score={info[0]['score']}\r\n").encode())
+                addr, score = info.best()
+                writer.write((f"- {client}: peer={addr} score={score}\r\n").encode())
         writer.write(b"Known interests:\r\n")
         for label, info in self.interests.items():
             writer.write((f"- {label}: clients={info.keys()}\r\n").encode())
+        queue = self.broadcast_queue
+        writer.write((f"Broadcast queue: {len(queue)} adverts, coalesced={queue.coalesced}, deferred={queue.deferred}\r\n").encode())
+        sends = sum(len(q) for q in self.send_queues.values())
+        writer.write((f"Send queues: {sends} items, coalesced={self.send_coalesced}, races={self.races}, races_won={self.races_won}\r\n").encode())
+        store = self.content_store
+        writer.write((f"Content store: {len(store)} labels, hits={store.hits}, misses={store.misses}, evictions={store.evictions}, expirations={store.expirations}\r\n").encode())
 
         writer.close()
 
+    # Prometheus text exposition of our metrics, plus values read on demand
+    def render_metrics(self) -> str:
+        store = self.content_store
+        queue = self.broadcast_queue
+        return self.metrics.render({
+            "tcdicn_send_queue_items": (
+                "gauge", "Items waiting to be sent to peers",
+                [((), sum(len(q) for q in self.send_queues.values()))]),
+            "tcdicn_broadcast_queue_adverts": (
+                "gauge", "Adverts waiting to be broadcast",
+                [((), len(queue))]),
+            "tcdicn_coalesced_total": (
+                "counter", "Queued items superseded before being sent",
+                [((("queue", "broadcast"),), queue.coalesced),
+                 ((("queue", "send"),), self.send_coalesced)]),
+            "tcdicn_broadcast_deferred_total": (
+                "counter", "Adverts held back by the advert cooldown",
+                [((), queue.deferred)]),
+            "tcdicn_races_total": (
+                "counter", "Batches also sent along a second route",
+                [((), self.races)]),
+            "tcdicn_races_won_total": (
+                "counter", "Races won by the second route",
+                [((), self.races_won)]),
+            "tcdicn_timers": (
+                "gauge", "Live timers in the timer wheel",
+                [((), self.timers.count)]),
+            "tcdicn_peers": (
+                "gauge", "Known peers", [((), len(self.peers))]),
+            "tcdicn_clients": (
+                "gauge", "Known clients", [((), len(self.clients))]),
+            "tcdicn_interests": (
+                "gauge", "Labels with known interests",
+                [((), len(self.interests))]),
+            "tcdicn_connections": (
+                "gauge", "Open outgoing and incoming persistent connections",
+                [((("direction", "out"),), len(self.connections)),
+                 ((("direction", "in"),), len(self.streams))]),
+            "tcdicn_open_circuits": (
+                "gauge", "Peers skipped by their circuit breaker",
+                [((), sum(
+                    not b.is_closed() for b in self.breakers.values()))]),
+            "tcdicn_content_store_labels": (
+                "gauge", "Labels cached in the content store",
+                [((), len(store))]),
+            "tcdicn_content_store_hits_total": (
+                "counter", "Content store lookups which found data",
+                [((), store.hits)]),
+            "tcdicn_content_store_misses_total": (
+                "counter", "Content store lookups which found nothing",
+                [((), store.misses)]),
+            "tcdicn_content_store_evictions_total": (
+                "counter", "Labels evicted from the content store",
+                [((), store.evictions)]),
+            "tcdicn_content_store_expirations_total": (
+                "counter", "Labels forgotten after their max age",
+                [((), store.expirations)]),
+        })
+
     # Common logic for handling both TCP and UDP messages
-    def on_message(self, log: Logger, addr: Addr, data: bytes):
+    def on_message(
+            self, log: Logger, addr: Addr, data: bytes, transport: str):
+        labels = (("transport", transport),)
+        self.metrics.inc("tcdicn_messages_received_total", labels)
+        self.metrics.inc("tcdicn_bytes_received_total", labels, len(data))
 
         # Parse message
         try:
@@ -867,10 +3282,26 @@ class Node:
         except (JSONDecodeError, KeyError, ValueError):
             log.warning("Ignored malformed message")
             return
+        self.count_items("tcdicn_items_received_total", transport, msg.items)
         if msg.version != VERSION:
             log.warning("Ignored message with version %s", msg.version)
             return
 
+        # Ignore own broadcasts, which always carry our node ID
+        for item in msg.items:
+            if type(item) is PeerItem and item.node == self.id:
+                log.debug("Ignored broadcast from self")
+                return
+
+        # Stamp the arrival of traced items
+        now = clock()
+        for item in msg.items:
+            trace = getattr(item, "trace", None)
+            if trace is not None and len(trace.hops) < TRACE_MAX_HOPS:
+                trace.hops.append(Trace.Hop(self.id, now))
+            elif trace is not None:
+                item.trace = None
+
         # Handle message items appropriately
         for item in msg.items:
             if type(item) is PeerItem:
@@ -901,23 +3332,26 @@ class Node:
 
         # Check for previous peer entry
         try:
-            self.peers[addr].timer.cancel()
+            timer = self.peers[addr].timer
             log.debug("Refreshed peer")
         except KeyError:
+            timer = None
             log.info("New peer")
 
         # Insert new peer entry with timeout
         def on_timeout():
             log.info("Timed out peer")
             del self.peers[addr]
-            for client, entries in self.routes.items():
-                for idx, route in enumerate(self.routes[client]):
-                    if route["addr"] == addr:
-                        del self.routes[client][idx]
-                        break
+            self.routes.remove_peer(addr)
+            self.costs.pop(addr, None)
+            breaker = self.breakers.pop(addr, None)
+            if breaker is not None and breaker.timer is not None:
+                self.timers.cancel(breaker.timer)
+            if addr in self.connections:
+                self.disconnect(addr, self.connections[addr])
 
         self.peers[addr] = peer
-        self.peers[addr].timer = do_after(peer.eol, on_timeout)
+        self.peers[addr].timer = self.timers.add(peer.eol, on_timeout, timer)
 
     def on_advert(self, log: Logger, addr: Addr, advert: AdvertItem):
         log = ContextLogger(log, f"{advert.client}")
@@ -928,59 +3362,63 @@ class Node:
             log.debug("Ignored advert for ourselves")
             return
 
-        # Update routes to client via peer
-        if advert.client not in self.routes:
-            self.routes[advert.client] = []
-        for idx, route in enumerate(self.routes[advert.client]):
-            if route["addr"] == addr:
-                self.routes[advert.client][idx]["score"] = advert.score
-                break
-        else:
-            new_route = {"addr": addr, "score": advert.score}
-            self.routes[advert.client].append(new_route)
-        self.routes[advert.client].sort(
-            key=lambda route: route["score"], reverse=True)
+        # Update routes to client via peer, net of the cost of using the peer
+        score = advert.score - self.route_cost(addr)
+        self.routes.update(advert.client, addr, score)
 
         # Check for previous client advert entry
         try:
             if advert.eol <= self.clients[advert.client].eol:
                 log.debug("Ignored old advert")
                 return
-            self.clients[advert.client].timer.cancel()
-            previous_labels = self.clients[advert.client].labels
+            timer = self.clients[advert.client].timer
+            previous_labels = set(self.clients[advert.client].labels)
             log.debug("Refreshed client")
         except KeyError:
-            previous_labels = []
+            timer = None
+            previous_labels = set()
             log.info("New client")
 
         # Insert new entry with timeout
         def on_timeout():
             log.info("Timed out client")
+            self.unindex_labels(advert.client, set(advert.labels))
             del self.clients[advert.client]
-            del self.routes[advert.client]
+            self.routes.remove_client(advert.client)
+            self.broadcast_queue.forget(advert.client)
 
         self.clients[advert.client] = advert
-        self.clients[advert.client].timer = do_after(advert.eol, on_timeout)
+        self.clients[advert.client].timer = \
+            self.timers.add(advert.eol, on_timeout, timer)
+
+        # Keep the label to publishers index up to date
+        labels = set(advert.labels)
+        added_labels = labels - previous_labels
+        self.unindex_labels(advert.client, previous_labels - labels)
+        for label in added_labels:
+            self.publishers.setdefault(label, set()).add(advert.client)
 
         # Additions to listed published labels results in interest propagation
-        for label in advert.labels:
-            if label not in previous_labels and label in self.interests:
+        for label in added_labels:
+            if label in self.interests:
                 for interest in self.interests[label].values():
-                    deadline = time.time() + interest.ttp
-                    routes = self.routes[advert.client] \
-                        if advert.client in self.routes else []
-                    self.send_queue.put_nowait(
-                        (deadline, advert.client, routes, interest))
-                    self.is_send_queue_changed = True
+                    deadline = clock() + interest.ttp
+                    routes = self.routes.get(advert.client)
+                    self.queue_send(deadline, advert.client, routes, interest)
                     log.debug("New get deadline: %s", to_human(deadline))
 
-        # Add advert to queue
-        deadline = time.time() + advert.ttp
-        self.broadcast_queue.put_nowait((deadline, advert))
+        # Add advert to queue, coalescing with any pending advert for client
+        deadline = clock() + advert.ttp
+        self.broadcast_queue.push(deadline, advert)
         self.is_broadcast_queue_changed = True
         log.debug("New advert deadline: %s", to_human(deadline))
 
-        # TODO(safely): cooldown / remove duplicates
+    # Forget that client publishes to labels
+    def unindex_labels(self, client: str, labels):
+        for label in labels:
+            self.publishers[label].discard(client)
+            if len(self.publishers[label]) == 0:
+                del self.publishers[label]
 
     def on_get(self, log: Logger, g: GetItem):
         log = ContextLogger(log, f"get {g.label}>{g.after}@{g.client}")
@@ -993,9 +3431,10 @@ class Node:
             if g.eol <= self.interests[g.label][g.client].eol:
                 log.debug("Ignored old interest")
                 return
-            self.interests[g.label][g.client].timer.cancel()
+            timer = self.interests[g.label][g.client].timer
             log.debug("Refreshed interest")
         except KeyError:
+            timer = None
             log.info("New interest from client")
 
         # Insert new entry with timeout
@@ -1007,35 +3446,34 @@ class Node:
                 del self.interests[g.label]
 
         self.interests[g.label][g.client] = g
-        self.interests[g.label][g.client].timer = do_after(g.eol, on_timeout)
+        self.interests[g.label][g.client].timer = \
+            self.timers.add(g.eol, on_timeout, timer)
+        if g.trace is not None and self.advert is not None \
+                and g.client != self.advert.client \
+                and g.label in self.advert.labels:
+            self.on_trace(g.label, g)
 
         # Add gets towards known publishers to queue
-        for client in self.clients:
-            if g.label in self.clients[client].labels:
-                if self.advert is None or self.advert.client != client:
-                    deadline = time.time() + g.ttp
-                    routes = self.routes[client] \
-                        if client in self.routes else []
-                    self.send_queue.put_nowait((deadline, client, routes, g))
-                    self.is_send_queue_changed = True
-                    log.debug("New get deadline: %s", to_human(deadline))
+        for client in self.publishers.get(g.label, ()):
+            if self.advert is None or self.advert.client != client:
+                deadline = clock() + g.ttp
+                routes = self.routes.get(client)
+                self.queue_send(deadline, client, routes, g)
+                log.debug("New get deadline: %s", to_human(deadline))
 
         # If we are a non-main node, we need to push to the device's main node
         if not self.is_main:
-            deadline = time.time() + g.ttp
-            self.send_queue.put_nowait((deadline, None, [], g))
-            self.is_send_queue_changed = True
+            deadline = clock() + g.ttp
+            self.queue_send(deadline, None, [], g)
             log.debug("New main get deadline: %s", to_human(deadline))
 
         # If we can fulfil this get, add sets toward client to queue
-        if g.label in self.content_store \
-                and self.content_store[g.label].at > g.after:
-            s = self.content_store[g.label]
-            s.dst = [(g.ttp, g.client)]
-            deadline = time.time() + g.ttp
-            routes = self.routes[g.client] if g.client in self.routes else []
-            self.send_queue.put_nowait((deadline, g.client, routes, s))
-            self.is_send_queue_changed = True
+        s = self.content_store.get(g.label)
+        if s is not None and s.at > g.after:
+            s = SetItem(s.label, s.data, s.at, [(g.ttp, g.client)], s.max_age)
+            deadline = clock() + g.ttp
+            routes = self.routes.get(g.client)
+            self.queue_send(deadline, g.client, routes, s)
             log.debug("New immediate set deadline: %s", to_human(deadline))
 
     def on_set(self, log: Logger, s: SetItem):
@@ -1050,25 +3488,29 @@ class Node:
             fulfil = self.content_store[s.label].fulfil
         except KeyError:
             log.debug("New label in content store")
-            last = 0
+            last = self.returned.get(s.label, 0)
             fulfil = None
 
         # Insert new entry
+        s.last = last
         self.content_store[s.label] = s
-        self.content_store[s.label].last = last
         log.info("Updated local content store")
 
         # Fulfil any local interests (applications waiting in .get())
         if fulfil is not None:
-            fulfil.set_result(True)
+            fulfil.set_result(s)
+        for subscription in self.subscriptions.get(s.label, ()):
+            subscription.push(s)
+        if s.trace is not None and self.advert is not None \
+                and any(c == self.advert.client for _, c in s.dst):
+            self.on_trace(s.label, s)
 
         # Add sets towards interested clients to queue
         for ttp, client in s.dst:
             if self.advert is None or self.advert.client != client:
-                deadline = time.time() + ttp
-                new_set_item = SetItem(s.label, s.data, s.at, [(ttp, client)])
-                routes = self.routes[client] \
-                    if client in self.routes else []
-                self.send_queue.put_nowait(
-                    (deadline, client, routes, new_set_item))
-                self.is_send_queue_changed = True
+                deadline = clock() + ttp
+                new_set_item = SetItem(
+                    s.label, s.data, s.at, [(ttp, client)], s.max_age,
+                    s.trace)
+                routes = self.routes.get(client)
+                self.queue_send(deadline, client, routes, new_set_item)